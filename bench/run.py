@@ -0,0 +1,234 @@
+"""Benchmarks for the parser and the whole crawler, run against the recorded pages in bench/fixtures so they never touch
+the live site. The parser benchmark first checks that parse_case_html still pulls the values saved in bench/expected.json
+from each recorded case page and the search hits saved for each recorded search page, so a change in what the parser
+finds is caught before its speed is measured, and then times it on each page. The crawler benchmark starts the local
+stand-in server, points the crawler at it and crawls a generated park list from an empty cache, the same way a real run
+would. After they run, a sink whose write fails is checked to keep its batch for the next flush.
+Run from the project directory with:
+
+    python -m bench.run
+    python -m bench.run --parks 50 --latency 0.05 --error-rate 0.02 --json bench_output.json
+
+or through the command line tool with python cli.py bench and the same options.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import crawler
+import extract
+import http_client
+import metrics
+import page_cache
+import parse_data
+import sinks
+from bench import server as stand_in
+
+
+expected_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'expected.json')
+
+
+# Compares what parse_case_html finds on every recorded case page, and the hits search_hits finds on every recorded search
+# page, with the values saved in expected.json, amounts are compared to the cent. Returns a list of the differences.
+def check_parser():
+    with open(expected_path, encoding='utf-8') as f:
+        expected = json.load(f)
+    differences = []
+    for name, html in stand_in.case_fixtures().items():
+        record = parse_data.parse_case_html(html)._asdict()
+        for field, value in expected.get(name, {}).items():
+            found = record[field]
+            if isinstance(value, (int, float)) and isinstance(found, (int, float)):
+                same = round(found, 2) == round(value, 2)
+            else:
+                same = found == value
+            if not same:
+                differences.append(f'{name} {field}: expected {value!r}, found {found!r}')
+        if name not in expected:
+            differences.append(f'{name}: no expected values saved')
+    # Search pages are checked for the case numbers and party names read from their results table
+    for name, html in stand_in.search_fixtures().items():
+        if name not in expected:
+            differences.append(f'{name}: no expected values saved')
+            continue
+        hits = [list(hit) for hit in extract.search_hits(extract.text_cells(html))]
+        if hits != expected[name]['hits']:
+            differences.append(f'{name} hits: expected {expected[name]["hits"]!r}, found {hits!r}')
+    return differences
+
+
+# Sends a batch through a CsvSink with a lead index whose first write fails, the way a sheet quota or network error
+# would. The failed batch must not be marked as sent or added to the index, and the next flush must write all of it.
+# Returns a list of what went wrong.
+def check_sink_retry():
+    import postprocess
+
+    problems = []
+    flushed = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'leads.csv')
+        sink = sinks.CsvSink(path, flush_rows=100, on_flush=flushed.extend, leads=postprocess.LeadIndex.from_rows([]))
+        write = sink.write
+        failures = ['quota exceeded']
+
+        def failing_write(buffer):
+            if failures:
+                raise RuntimeError(failures.pop())
+            write(buffer)
+
+        sink.write = failing_write
+        for case_number in ('CC1', 'CC2'):
+            sink.add(case_number, dict.fromkeys(sinks.columns, case_number))
+        try:
+            sink.flush()
+            problems.append('the failing write did not raise')
+        except RuntimeError:
+            pass
+        if flushed:
+            problems.append(f'cases marked sent after a failed write: {flushed}')
+        if sink.leads.leads:
+            problems.append(f'cases added to the lead index after a failed write: {sorted(sink.leads.leads)}')
+
+        sink.flush()
+        written = [case_number for case_number, row in sinks.read_rows('csv', path)] if os.path.exists(path) else []
+        if written != ['CC1', 'CC2']:
+            problems.append(f'the retried flush wrote {written}, expected CC1 and CC2')
+        if flushed != ['CC1', 'CC2']:
+            problems.append(f'the retried flush marked {flushed} as sent, expected CC1 and CC2')
+    return problems
+
+
+# Times parse_case_html on every recorded case page
+def bench_parser(iterations=200):
+    differences = check_parser()
+    if differences:
+        raise SystemExit('The parser no longer finds the expected values:\n  ' + '\n  '.join(differences))
+    pages = stand_in.case_fixtures()
+    results = {}
+    total_seconds = 0
+    for name, html in pages.items():
+        # One untimed parse so imports and caches don't count
+        parse_data.parse_case_html(html)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            parse_data.parse_case_html(html)
+        seconds = time.perf_counter() - start
+        total_seconds += seconds
+        results[name] = {'us_per_page': seconds / iterations * 1e6}
+
+    tracemalloc.start()
+    for html in pages.values():
+        parse_data.parse_case_html(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    page_count = iterations * len(pages)
+    return {
+        'backend': parse_data.extract.backend,
+        'pages': results,
+        'us_per_page': total_seconds / page_count * 1e6,
+        'pages_per_second': page_count / total_seconds,
+        'peak_memory_bytes': peak,
+    }
+
+
+# Crawls a generated park list against the stand-in server and measures the whole pipeline
+def bench_crawler(parks=20, year=2023, latency=0.0, error_rate=0.0, concurrency=8, requests_per_second=1000, parse_workers=None):
+    park_names = [f'Bench Park {i} Mobile Home Park' for i in range(parks)]
+    site = stand_in.start_server(latency=latency, error_rate=error_rate, park_names=park_names)
+    crawler.base_url = site.base + '/app/courtrecords/caseSearchResults?bName='
+    crawler.case_url = site.base + '/app/courtrecords/CaseInfo?casenumber={}000'
+    http_client.configure(retries=3)
+    http_client.backoff_base = 0.05
+    records = []
+
+    def handle_record(case_number, record):
+        records.append(case_number)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        page_cache.configure(directory=cache_dir, offline_mode=False)
+        metrics.reset()
+        start = time.perf_counter()
+        # The crawler prints every URL, which would swamp the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(crawler.crawl(park_names, year, handle_record, concurrency=concurrency, requests_per_second=requests_per_second,
+                                      parse_workers=parse_workers))
+        seconds = time.perf_counter() - start
+
+    site.shutdown()
+    site.server_close()
+    requests_served = sum(site.responses.values())
+    return {
+        'parks': parks,
+        'seconds': seconds,
+        'requests': requests_served,
+        'status_codes': {str(status): count for status, count in sorted(site.responses.items())},
+        'cases': len(records),
+        'pages_per_second': requests_served / seconds,
+        'cases_per_minute': len(records) / seconds * 60,
+        # Linux reports the peak resident size in kilobytes
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'peak_rss_parsers_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        # Per-stage counters and latencies from the crawler's own instrumentation
+        'metrics': metrics.summary(),
+    }
+
+
+def print_report(report):
+    parser_report = report.get('parser')
+    if parser_report:
+        print(f"Parser ({parser_report['backend']})")
+        for name, result in parser_report['pages'].items():
+            print(f"  {name:<32} {result['us_per_page']:>10.1f} us/page")
+        print(f"  {'all pages':<32} {parser_report['us_per_page']:>10.1f} us/page  {parser_report['pages_per_second']:>10.0f} pages/sec")
+        print(f"  peak memory {parser_report['peak_memory_bytes'] / 1024:.0f} KiB")
+
+    crawler_report = report.get('crawler')
+    if crawler_report:
+        print(f"Crawler ({crawler_report['parks']} parks)")
+        print(f"  {crawler_report['requests']} requests in {crawler_report['seconds']:.2f} s, status codes {crawler_report['status_codes']}")
+        print(f"  {crawler_report['pages_per_second']:.1f} pages/sec, {crawler_report['cases_per_minute']:.0f} cases/minute")
+        print(f"  peak memory {crawler_report['peak_rss_bytes'] / 1024 / 1024:.1f} MiB, parsers {crawler_report['peak_rss_parsers_bytes'] / 1024 / 1024:.1f} MiB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bench', description='Benchmark the parser and crawler against recorded court pages')
+    parser.add_argument('--only', choices=['parser', 'crawler'], help='Run a single benchmark')
+    parser.add_argument('--iterations', type=int, default=200, help='Times each recorded page is parsed')
+    parser.add_argument('--parks', type=int, default=20, help='Number of parks crawled')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the stand-in server waits before each response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of stand-in responses turned into 503 errors')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=1000, help='Requests per second allowed by the rate limiter')
+    parser.add_argument('--parse-workers', type=int)
+    parser.add_argument('--json', help='Also write the report to this file')
+    args = parser.parse_args(argv)
+
+    report = {}
+    if args.only in (None, 'parser'):
+        report['parser'] = bench_parser(args.iterations)
+    if args.only in (None, 'crawler'):
+        report['crawler'] = bench_crawler(args.parks, latency=args.latency, error_rate=args.error_rate, concurrency=args.concurrency,
+                                          requests_per_second=args.rate, parse_workers=args.parse_workers)
+
+    # Run after the benchmarks since it loads pandas, which would count towards the crawler's peak memory
+    problems = check_sink_retry()
+    if problems:
+        raise SystemExit('A sink loses rows when a write fails:\n  ' + '\n  '.join(problems))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
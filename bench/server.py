@@ -0,0 +1,172 @@
+"""Local stand-in for the court records site, used by the benchmarks so they never touch the live site. It replays the
+recorded pages in bench/fixtures. Search results are built from the recorded search page with case numbers that are
+worked out from the search terms, so different parks return different cases and the same park always returns the same
+ones, and about one search in four returns no results so the broader search gets exercised. The party name of each
+result is the searched name, except that some results of a broader search than a park's full name belong to another
+park of the crawled list and some to an unrelated park, the way a broad search also turns up other parks' cases, so the park index has hits to drop and hits it
+can't match. Case pages are picked from the recorded case pages by case number, with the plaintiff replaced by the
+party name the search listed for the case. A delay can be added to every response, and a share of responses can be
+turned into 503 errors to exercise the http client's retries."""
+
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+# Reads a recorded page from the fixtures directory
+def load_fixture(name):
+    with open(os.path.join(fixtures_dir, name), encoding='utf-8') as f:
+        return f.read()
+
+
+# Every recorded case page, used by the parser benchmark and served for case URLs
+def case_fixtures():
+    return {name: load_fixture(name) for name in sorted(os.listdir(fixtures_dir)) if name.startswith('case_')}
+
+
+# Every recorded search results page, checked by the parser benchmark
+def search_fixtures():
+    return {name: load_fixture(name) for name in sorted(os.listdir(fixtures_dir)) if name.startswith('search_')}
+
+
+# Plaintiffs of the recorded case pages, replaced by the party name of the search result that listed the case
+fixture_plaintiffs = ['SAMPLE PALMS MHP LLC', 'PLACEHOLDER RV RESORT INC', 'EXAMPLE ESTATES MOBILE HOME COMMUNITY']
+
+
+# A stable number worked out from a piece of text, used so the same request always gets the same answer
+def stable_hash(text):
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, seed=0, park_names=None):
+        super().__init__(address, StandInHandler)
+        # Parks of the crawled list, some search results are given to one of them instead of the searched name
+        self.park_names = park_names or []
+        # Party name listed for each case number in the search results sent so far
+        self.parties = {}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.search_page = load_fixture('search_results.html')
+        self.empty_search_page = load_fixture('search_no_results.html')
+        self.case_pages = list(case_fixtures().values())
+        self.lock = threading.Lock()
+        # Counts of responses sent, by status code
+        self.responses = {}
+
+    # Base URL of the site, to be used in place of https://justicecourts.maricopa.gov
+    @property
+    def base(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, status):
+        with self.lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    # Builds a search results page with case numbers worked out from the search terms
+    def search_results(self, name, year):
+        key = stable_hash(f'{name.lower()}|{year}')
+        if key % 4 == 0:
+            return self.empty_search_page
+        case_numbers = iter(f'CC{year}{(key + i * 7919) % 1000000:06d}' for i in range(100))
+        # The same recorded case number appears in the link and its text, so both get the same replacement
+        replacements = {}
+        page = re.sub(r'CC\d{10}', lambda match: replacements.setdefault(match.group(0), next(case_numbers)), self.search_page)
+        # A search for a park's full name only lists that park, broader searches also list other parks
+        exact = name.lower() in (park_name.lower() for park_name in self.park_names)
+        others = [park_name for park_name in self.park_names if park_name.lower() != name.lower()]
+        parties = []
+        for i in range(len(replacements)):
+            if exact:
+                parties.append(f'{name.upper()} LLC')
+            elif i % 5 == 2 and others:
+                parties.append(f'{others[(key + i) % len(others)].upper()} LLC')
+            elif i % 5 == 4:
+                parties.append('UNRELATED ACRES LLC')
+            else:
+                parties.append(f'{name.upper()} LLC')
+        with self.lock:
+            self.parties.update(zip(replacements.values(), parties))
+        parties = iter(parties)
+        return re.sub(r'SAMPLE PALMS MHP LLC', lambda match: next(parties), page)
+
+    # Case pages are requested with three more digits than the search results show
+    def case_page(self, case_number):
+        page = self.case_pages[stable_hash(case_number) % len(self.case_pages)]
+        with self.lock:
+            party = self.parties.get(case_number[:-3])
+        if party is None:
+            return page
+        return re.sub('|'.join(fixture_plaintiffs), party, page)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.should_fail():
+            self.reply(503, 'Service Unavailable', {'Retry-After': '0'})
+            return
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith('/caseSearchResults'):
+            self.reply(200, server.search_results(query.get('bName', [''])[0], query.get('year', [''])[0]))
+        elif url.path.endswith('/CaseInfo'):
+            self.reply(200, server.case_page(query.get('casenumber', [''])[0]))
+        else:
+            self.reply(404, 'Not Found')
+
+    def reply(self, status, body, headers=None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count(status)
+
+    # Requests are counted instead of logged
+    def log_message(self, format, *args):
+        pass
+
+
+# Starts the stand-in server on a free port in a background thread
+def start_server(latency=0.0, error_rate=0.0, seed=0, host='127.0.0.1', port=0, park_names=None):
+    server = StandInServer((host, port), latency=latency, error_rate=error_rate, seed=seed, park_names=park_names)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve the recorded court pages locally')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of responses turned into 503 errors')
+    args = parser.parse_args()
+
+    server = StandInServer(('127.0.0.1', args.port), latency=args.latency, error_rate=args.error_rate)
+    print(f'Serving recorded pages at {server.base}')
+    server.serve_forever()
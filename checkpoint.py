@@ -0,0 +1,174 @@
+"""Local checkpoint store kept in a SQLite file. It records which parks have been searched for each year, every case number
+that has been seen along with whether it was sent to the google sheet, the rows that are waiting to be sent, and a
+cursor marking how far through the park list a run has made it. If a run crashes the waiting rows are not lost, and a
+resumed run skips the parks that were already searched. Case numbers that were already seen are never downloaded
+again, so day to day reruns only fetch new cases. For refreshing known cases it also keeps the ETag, Last-Modified value
+and content hash of each case page from when it was last checked, and rows that changed and still need to replace the
+row already in the sheet. The park index's plaintiff names and working queries for each park are saved here as well."""
+
+import json
+import sqlite3
+import threading
+import time
+
+default_path = 'checkpoint.db'
+
+
+class Checkpoint:
+    def __init__(self, path=default_path):
+        self.path = path
+        # The crawler and the export writer use the checkpoint from different threads, so access is serialized by a lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # Queries saved before they were kept per year can't be placed in a year, so that table is dropped and made again
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(park_queries)')]
+        if columns and 'year' not in columns:
+            self.conn.execute('DROP TABLE park_queries')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS searched_parks (
+                year INTEGER NOT NULL,
+                park TEXT NOT NULL,
+                searched_at REAL NOT NULL,
+                PRIMARY KEY (year, park)
+            );
+            CREATE TABLE IF NOT EXISTS cases (
+                case_number TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                row_json TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS cursors (
+                year INTEGER PRIMARY KEY,
+                position INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS case_pages (
+                case_number TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                checked_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS park_plaintiffs (
+                park TEXT NOT NULL,
+                plaintiff TEXT NOT NULL,
+                PRIMARY KEY (park, plaintiff)
+            );
+            CREATE TABLE IF NOT EXISTS park_queries (
+                park TEXT NOT NULL,
+                year INTEGER NOT NULL,
+                words_json TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (park, year)
+            );
+        ''')
+        self.conn.commit()
+
+    # Called at the start of a run that is not being resumed, so every park is searched again
+    def start_run(self, year):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM searched_parks WHERE year = ?', (year,))
+            self.conn.execute('DELETE FROM cursors WHERE year = ?', (year,))
+
+    def park_searched(self, year, park):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM searched_parks WHERE year = ? AND park = ?', (year, park)).fetchone()
+        return row is not None
+
+    def mark_park_searched(self, year, park):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO searched_parks VALUES (?, ?, ?)', (year, park, time.time()))
+
+    # Number of parks at the start of the park list that have all been searched
+    def cursor(self, year):
+        with self.lock:
+            row = self.conn.execute('SELECT position FROM cursors WHERE year = ?', (year,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def set_cursor(self, year, position):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?)', (year, position))
+
+    # A case has been seen if it is waiting to be sent, was sent, or had no data worth sending
+    def case_seen(self, case_number):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM cases WHERE case_number = ?', (case_number,)).fetchone()
+        return row is not None
+
+    # Cases without any data for the sheet are recorded so they aren't downloaded again
+    def mark_case_skipped(self, case_number):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO cases VALUES (?, ?, NULL, ?)', (case_number, 'skipped', time.time()))
+
+    # Rows are saved here as soon as they are built so they survive a crash before being sent
+    def add_pending(self, case_number, row):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO cases VALUES (?, ?, ?, ?)', (case_number, 'pending', json.dumps(row), time.time()))
+
+    # Rows built in an earlier run that never made it to the sheet, as (case_number, row) pairs
+    def pending_rows(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT case_number, row_json FROM cases WHERE status = 'pending' ORDER BY updated_at").fetchall()
+        return [(case_number, json.loads(row_json)) for case_number, row_json in rows]
+
+    # Called once a batch of rows has been sent to the sheet
+    def mark_exported(self, case_numbers):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE cases SET status = 'exported', updated_at = ? WHERE case_number = ?",
+                                  [(now, case_number) for case_number in case_numbers])
+
+    # Cases that are still open, ones whose exported row has no judgment yet, as (case_number, row, validators) where
+    # validators is the (etag, last_modified, content_hash) of the page from the last refresh, all None if it never had one
+    def open_cases(self):
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT cases.case_number, cases.row_json, case_pages.etag, case_pages.last_modified, case_pages.content_hash
+                FROM cases LEFT JOIN case_pages ON case_pages.case_number = cases.case_number
+                WHERE cases.status = 'exported' AND cases.row_json IS NOT NULL
+                ORDER BY cases.updated_at
+            """).fetchall()
+        open_cases = []
+        for case_number, row_json, etag, last_modified, content_hash in rows:
+            row = json.loads(row_json)
+            if row.get('judgments') == 'N':
+                open_cases.append((case_number, row, (etag, last_modified, content_hash)))
+        return open_cases
+
+    def set_page_validators(self, case_number, etag, last_modified, content_hash):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO case_pages VALUES (?, ?, ?, ?, ?)',
+                              (case_number, etag, last_modified, content_hash, time.time()))
+
+    # A refreshed row that differs from the exported one, it waits here until it has replaced the row in the sheet
+    def mark_changed(self, case_number, row):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO cases VALUES (?, ?, ?, ?)', (case_number, 'changed', json.dumps(row), time.time()))
+
+    # Changed rows an earlier refresh never finished sending, as (case_number, row) pairs
+    def changed_rows(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT case_number, row_json FROM cases WHERE status = 'changed' ORDER BY updated_at").fetchall()
+        return [(case_number, json.loads(row_json)) for case_number, row_json in rows]
+
+    # Plaintiffs seen on each park's cases, as (park, plaintiff) pairs
+    def park_plaintiffs(self):
+        with self.lock:
+            return self.conn.execute('SELECT park, plaintiff FROM park_plaintiffs').fetchall()
+
+    def add_park_plaintiff(self, park, plaintiff):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO park_plaintiffs VALUES (?, ?)', (park, plaintiff))
+
+    # The search words that last found cases for each park
+    def park_queries(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT park, year, words_json FROM park_queries').fetchall()
+        return {(park, year): json.loads(words_json) for park, year, words_json in rows}
+
+    def set_park_query(self, park, year, words):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO park_queries VALUES (?, ?, ?, ?)', (park, year, json.dumps(words), time.time()))
+
+    def close(self):
+        self.conn.close()
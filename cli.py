@@ -0,0 +1,287 @@
+"""Command line tool for the lead generator. Each job is its own subcommand:
+
+    python cli.py crawl        search every park and send the new leads to the output
+    python cli.py refresh      recheck open cases and update the rows that changed
+    python cli.py export       send rows saved locally, or the merged rows of a sharded crawl, to the google sheet
+    python cli.py parse-file   parse saved case or search pages and print what was found
+    python cli.py bench        run the benchmarks in bench/
+
+Settings that don't change from run to run, like the sheet, worksheet names, years and credentials, are read from an
+INI file, lead_gen.ini in the current directory or the file given with --config. Settings in the [lead_gen] section
+apply to every subcommand and a section named after a subcommand applies to that one only, options given on the
+command line win over both. Only the modules a subcommand needs are imported, pandas and the google libraries are
+loaded only when a run uses the lead index or the sheet, so parsing a page starts almost immediately."""
+
+import argparse
+import configparser
+import json
+import os
+import sys
+from datetime import date
+
+import checkpoint
+import http_client
+import page_cache
+import shards
+import sinks
+
+default_config = 'lead_gen.ini'
+config_section = 'lead_gen'
+
+
+# Parses a year like 2025 or a range of years like 2022-2025, a range becomes a list of years
+def year_range(text):
+    if '-' in text:
+        first_year, last_year = text.split('-')
+        return list(range(int(first_year), int(last_year) + 1))
+    return int(text)
+
+
+# Options shared by every subcommand that uses the google sheet. They have no defaults, a run that needs one stops unless
+# it is set in the config file or on the command line.
+def sheet_options():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--sheet-id', help='Name of the google file')
+    parser.add_argument('--park-list', help='Worksheet holding the park list')
+    parser.add_argument('--sheet-name', help='Worksheet the leads are sent to')
+    parser.add_argument('--credentials', help='Google cloud service account json file')
+    return parser
+
+
+# Options for downloading from the court site. offline is left out for subcommands that always download, like refresh.
+def network_options(offline=True):
+    parser = argparse.ArgumentParser(add_help=False)
+    if offline:
+        parser.add_argument('--offline', action='store_true', help='Only use pages already in the cache, nothing is downloaded')
+    parser.add_argument('--cache-dir', default=page_cache.cache_dir, help='Directory where downloaded pages are cached')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of requests allowed in flight at once')
+    parser.add_argument('--rate', type=float, default=0.5, help='Maximum requests per second sent to the court site')
+    parser.add_argument('--timeout', type=float, default=http_client.read_timeout, help='Seconds to wait for the court site to respond')
+    parser.add_argument('--retries', type=int, default=http_client.max_retries, help='Number of times a failed request is retried')
+    return parser
+
+
+# Options for where rows are sent and the files a run keeps
+def output_options():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--output', default='sheet', choices=['sheet'] + list(sinks.local_sinks), help='Where the rows are sent')
+    parser.add_argument('--output-path', default='leads.csv', help='File written by the csv, parquet and sqlite outputs')
+    parser.add_argument('--batch-size', type=int, default=20, help='Number of rows sent at a time')
+    parser.add_argument('--no-dedupe', dest='dedupe', action='store_false', help='Send every row without checking what is already in the output')
+    parser.add_argument('--checkpoint', default=checkpoint.default_path, help='SQLite file where run progress is saved')
+    parser.add_argument('--metrics-json', default='run_report.json', help='File the JSON run report is written to')
+    parser.add_argument('--metrics-prom', help='Also write the run metrics to this file in the Prometheus text format')
+    return parser
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description='Generate eviction leads from the justice court records site')
+    parser.add_argument('--config', help=f'INI file with settings for the subcommands, {default_config} is used if it exists')
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+    subparsers = {}
+
+    crawl = commands.add_parser('crawl', parents=[sheet_options(), network_options(), output_options()],
+                                help='Search every park and send the new leads to the output')
+    crawl.add_argument('--years', type=year_range, default=date.today().year,
+                       help='Year or range of years to search, like 2025 or 2022-2025, defaults to the current year')
+    crawl.add_argument('--from-date', type=date.fromisoformat, help='Only keep cases filed on or after this date (YYYY-MM-DD)')
+    crawl.add_argument('--to-date', type=date.fromisoformat, help='Only keep cases filed on or before this date (YYYY-MM-DD)')
+    crawl.add_argument('--resume', action='store_true', help='Skip parks that were already searched by an unfinished run')
+    crawl.add_argument('--reparse', action='store_true',
+                       help='Handle cases the checkpoint has already seen again, on by default with --offline so cached pages are re-parsed')
+    crawl.add_argument('--no-filter-hits', dest='filter_hits', action='store_false',
+                       help='Keep every hit of a broad search instead of dropping hits whose party name belongs to another park')
+    crawl.add_argument('--park-file', help='Read the park list from a local CSV file instead of the google sheet')
+    crawl.add_argument('--parse-workers', type=int, help='Number of processes used to parse pages, defaults to the number of cores')
+    crawl.add_argument('--lead-totals', help='Write the total owed per defendant and per plaintiff across all leads to this CSV file')
+    crawl.add_argument('--shards', type=int, help='Split the park list into this many shards, claimed from the ledger by each worker')
+    crawl.add_argument('--shard', type=int, help='With --shards, crawl only this shard instead of claiming them from the ledger')
+    crawl.add_argument('--ledger', default=shards.default_ledger, help='SQLite file shared by the workers of a sharded crawl')
+    crawl.set_defaults(run=run_crawl)
+    subparsers['crawl'] = crawl
+
+    # Refreshing means downloading the current page, so there is no offline mode
+    refresh = commands.add_parser('refresh', parents=[sheet_options(), network_options(offline=False), output_options()],
+                                  help='Recheck open cases already in the checkpoint and update the rows that changed')
+    refresh.set_defaults(run=run_refresh)
+    subparsers['refresh'] = refresh
+
+    export = commands.add_parser('export', parents=[sheet_options(), output_options()],
+                                 help='Send rows saved by a local output, or the merged shards of a crawl, to the google sheet')
+    export.add_argument('--shards', type=int, help='Merge the output of this many shards, dropping cases found by more than one')
+    export.add_argument('--ledger', default=shards.default_ledger, help='SQLite file shared by the workers of a sharded crawl')
+    export.add_argument('--merge-path', help='Write the merged shard rows to this local file instead of the google sheet')
+    export.set_defaults(run=run_export)
+    subparsers['export'] = export
+
+    parse_file = commands.add_parser('parse-file', help='Parse saved case or search result pages and print what was found as JSON')
+    parse_file.add_argument('paths', nargs='+', help='Saved html files')
+    parse_file.add_argument('--search', action='store_true', help='The files are search result pages, print their case numbers')
+    parse_file.set_defaults(run=run_parse_file)
+    subparsers['parse-file'] = parse_file
+
+    bench = commands.add_parser('bench', help='Run the benchmarks, every option after bench is passed on to them', add_help=False)
+    bench.set_defaults(run=run_bench)
+    subparsers['bench'] = bench
+
+    return parser, subparsers
+
+
+# Reads the config file, the default one is optional but one given with --config has to exist
+def read_config(path):
+    config = configparser.ConfigParser(interpolation=None)
+    if path is None:
+        if not os.path.exists(default_config):
+            return config
+        path = default_config
+    elif not os.path.exists(path):
+        raise SystemExit(f'Config file not found: {path}')
+    config.read(path, encoding='utf-8')
+    return config
+
+
+# Turns the settings of the config file into defaults for each subcommand. Values are given to argparse as text so they
+# go through the same conversion as options typed on the command line.
+def apply_config(parser, subparsers, config):
+    shared = dict(config[config_section]) if config.has_section(config_section) else {}
+    used = set()
+    for name, subparser in subparsers.items():
+        settings = dict(shared)
+        if config.has_section(name):
+            settings.update(config[name])
+        actions = {action.dest: action for action in subparser._actions}
+        defaults = {}
+        for key, value in settings.items():
+            dest = key.replace('-', '_')
+            action = actions.get(dest)
+            if action is None:
+                if key not in shared:
+                    parser.error(f'Unknown setting {key} in the [{name}] section of the config file')
+                continue
+            used.add(key)
+            # Flags are turned on or off by yes/no, true/false or 1/0
+            if action.nargs == 0:
+                if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                    parser.error(f'Setting {key} in the config file must be yes or no')
+                value = configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+            defaults[dest] = value
+        subparser.set_defaults(**defaults)
+
+    for key in shared:
+        if key not in used:
+            parser.error(f'Unknown setting {key} in the [{config_section}] section of the config file')
+
+
+# Stops with an error naming every setting in names that was set neither in the config file nor on the command line
+def require(args, *names):
+    missing = ['--' + name.replace('_', '-') for name in names if getattr(args, name) is None]
+    if missing:
+        raise SystemExit(f'{args.command} needs {", ".join(missing)}, set on the command line or in {default_config}')
+
+
+# Checks the sheet settings a run needs when it reads the park list from the sheet or sends its rows there
+def require_sheet(args, reads_parks=False, sends_rows=False):
+    names = []
+    if reads_parks:
+        names += ['sheet_id', 'park_list']
+    if sends_rows:
+        names += ['sheet_id', 'sheet_name']
+    if names:
+        names.append('credentials')
+    require(args, *dict.fromkeys(names))
+
+
+def configure_network(args):
+    page_cache.configure(directory=args.cache_dir, offline_mode=getattr(args, 'offline', False))
+    http_client.configure(read_seconds=args.timeout, retries=args.retries)
+
+
+def run_crawl(args):
+    import main
+
+    # Sharded runs always write to local files
+    require_sheet(args, reads_parks=args.park_file is None, sends_rows=args.output == 'sheet' and not args.shards)
+    configure_network(args)
+    main.cred_file = args.credentials
+    years = args.years
+    date_range = None
+    if args.from_date is not None or args.to_date is not None:
+        first_year = min(years) if isinstance(years, list) else years
+        date_range = (args.from_date or date(first_year, 1, 1), args.to_date or date.today())
+
+    options = dict(concurrency=args.concurrency, requests_per_second=args.rate, checkpoint_path=args.checkpoint, resume=args.resume,
+                   batch_size=args.batch_size, output=args.output, output_path=args.output_path, park_file=args.park_file,
+                   parse_workers=args.parse_workers, metrics_json=args.metrics_json, metrics_prom=args.metrics_prom,
+                   date_range=date_range, dedupe=args.dedupe, reparse=args.reparse or args.offline, filter_hits=args.filter_hits)
+    if args.shards and args.shard is not None:
+        main.run_shard(years, args.sheet_id, args.park_list, args.shard, args.shards, **options)
+    elif args.shards:
+        main.run_shard_worker(years, args.sheet_id, args.park_list, args.shards, ledger_path=args.ledger, **options)
+    else:
+        main.get_url(years, args.sheet_id, args.park_list, args.sheet_name, lead_totals=args.lead_totals, **options)
+
+
+def run_refresh(args):
+    import main
+
+    require_sheet(args, sends_rows=args.output == 'sheet')
+    configure_network(args)
+    main.cred_file = args.credentials
+    main.refresh_cases(args.sheet_id, args.sheet_name, concurrency=args.concurrency, requests_per_second=args.rate,
+                       checkpoint_path=args.checkpoint, batch_size=args.batch_size, output=args.output, output_path=args.output_path,
+                       metrics_json=args.metrics_json, metrics_prom=args.metrics_prom, dedupe=args.dedupe)
+
+
+def run_export(args):
+    import main
+
+    if args.output == 'sheet':
+        raise SystemExit('export reads rows saved by a local output, pick one with --output csv, parquet or sqlite')
+    if not args.shards or args.merge_path is None:
+        require_sheet(args, sends_rows=True)
+    main.cred_file = args.credentials
+    if args.shards:
+        main.merge_shards(args.output, args.output_path, args.shards, args.sheet_id, args.sheet_name, merge_path=args.merge_path,
+                          ledger_path=args.ledger, dedupe=args.dedupe)
+    else:
+        main.push_to_sheet(args.output, args.output_path, args.sheet_id, args.sheet_name, dedupe=args.dedupe)
+
+
+def run_parse_file(args):
+    import extract
+    import parse_data
+
+    for path in args.paths:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        if args.search:
+            result = {'path': path, 'hits': [{'case_number': case_number, 'party': party}
+                                             for case_number, party in extract.search_hits(extract.text_cells(html))]}
+        else:
+            result = dict(parse_data.parse_case_html(html, path)._asdict())
+        print(json.dumps(result))
+
+
+def run_bench(args):
+    from bench import run
+
+    run.main(args.bench_args)
+
+
+def main(argv=None):
+    parser, subparsers = build_parser()
+    # The config file has to be read before the options are parsed, since its settings become their defaults
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument('--config')
+    known, _ = pre_parser.parse_known_args(argv)
+    apply_config(parser, subparsers, read_config(known.config))
+    # Options after bench are left for the benchmarks' own parser
+    args, extra = parser.parse_known_args(argv)
+    if extra and args.command != 'bench':
+        parser.error(f'unrecognized arguments: {" ".join(extra)}')
+    args.bench_args = extra
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
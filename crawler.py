@@ -0,0 +1,405 @@
+"""Concurrent crawler for the court records site. Searches for each mobile home park and the case pages they return are
+downloaded by a pool of worker threads driven by asyncio, so several requests can be in flight at once, while the pages
+are parsed in a pool of processes and exported by a single writer. Politeness toward
+the court site comes from a token bucket shared by every worker, each download has to take a token first, which caps the
+number of requests per second no matter how many workers are running. Pages served from the cache never take a token.
+Pages that could not be downloaded are collected by the http client and tried again once every park has been searched.
+Known cases can also be refreshed on their own, without searching, to pick up new judgments and changed amounts."""
+
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote
+
+import http_client
+import metrics
+import page_cache
+import park_index
+import parse_data
+import planner
+
+# URL templates used to generate new URLs for each court case search and each case
+base_url = "https://justicecourts.maricopa.gov/app/courtrecords/caseSearchResults?bName="
+case_url = "https://justicecourts.maricopa.gov/app/courtrecords/CaseInfo?casenumber={}000"
+
+# Words removed from a park name when the exact search returns nothing, removing these words allows for a broader search
+broad_search_stop_words = ['mobile', 'rv', 'park', 'home', 'subdivision', 'resort', 'estate', 'estates', 'community', 'trailer']
+
+
+# Token bucket used to limit the number of requests sent to the court site, it is shared between threads
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Blocks until a token is available and then takes it, the time spent waiting is recorded
+    def acquire(self):
+        start = time.perf_counter()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    metrics.observe('rate_limit_wait_seconds', time.perf_counter() - start)
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Build a search URL from the words of a park name, characters like & are escaped so they stay part of the name
+def search_url(words, year):
+    return base_url + '%20'.join(quote(word, safe='') for word in words) + f'&year={year}'
+
+
+# Words used for the broader search, the park name in lowercase with certain keywords removed
+def broad_search_words(words):
+    return [word for word in (element.lower() for element in words) if word not in broad_search_stop_words]
+
+
+# Search for a park, if no case numbers are returned the search is retried with certain keywords removed.
+# With a SearchCache, searches that were already made during the run are not sent again. With a ParkIndex, the query
+# that found the park's cases in the same year before is tried first, and hits from any query other than the park's exact name are
+# checked against the index so cases belonging to other parks are never downloaded.
+def find_case_numbers(park_name, year, searches=None, parks=None):
+    words = park_name.split()
+
+    def search(search_words, step):
+        url = search_url(search_words, year)
+        print('URL:', url)
+        with metrics.timer('search_seconds', step=step):
+            return parse_data.get_search_hits(url)
+
+    plan = [(words, 'exact'), (broad_search_words(words), 'broad')]
+    known_words = parks.best_query(park_name, year) if parks is not None else None
+    if known_words is not None:
+        plan.insert(0, (known_words, 'known'))
+
+    hits = []
+    tried = set()
+    for search_words, step in plan:
+        key = planner.query_key(search_words)
+        if key in tried:
+            continue
+        tried.add(key)
+        if searches is None:
+            hits = search(search_words, step)
+        else:
+            hits = searches.get(search_words, year, lambda: search(search_words, step))
+        if hits is None:
+            return None
+        if parks is not None and key != planner.query_key(words):
+            hits = parks.filter_hits(park_name, hits)
+        if hits:
+            if parks is not None:
+                parks.learn_query(park_name, year, search_words)
+            break
+
+    case_numbers = [case_number for case_number, party in hits]
+    metrics.increment('cases_found', len(case_numbers))
+    return case_numbers
+
+
+# Runs in the parsing processes, the metrics recorded while parsing are sent back with the record
+def parse_case_with_metrics(html, url):
+    with metrics.timer('parse_case_seconds'):
+        record = parse_data.parse_case_html(html, url)
+    return record, metrics.drain()
+
+
+# Checks whether a case was filed inside a date window, cases whose page has no file date, or one that can't be read, are
+# kept
+def filed_within(record, start_date, end_date):
+    if record.file_date is None:
+        return True
+    try:
+        filed = datetime.strptime(record.file_date, '%m/%d/%Y').date()
+    except ValueError:
+        metrics.increment('unparsed_file_dates')
+        return True
+    return start_date <= filed <= end_date
+
+
+# The years that have to be searched to cover a date window
+def years_between(start_date, end_date):
+    return list(range(start_date.year, end_date.year + 1))
+
+
+# Pull the case number back out of a case page URL
+def case_number_from_url(url):
+    return url.split('casenumber=')[-1][:-3]
+
+
+# Runs the searches and case downloads for every park, handle_record is called with each case number and its CaseRecord.
+# The work is split into stages joined by bounded queues: worker threads download pages, a pool of processes parses them,
+# and a single writer thread hands the records to handle_record. When a stage falls behind the queue in front of it fills
+# up and the stage before it waits, so memory stays flat. Pages that still fail after the http client's retries are tried
+# again in up to retry_rounds passes at the end. With a checkpoint, case numbers it has already seen are skipped, and a
+# resumed run also skips parks already searched. With reparse, cases the checkpoint has seen are handled again, used to
+# re-parse cached pages after a parser fix. tick, if given, is called on the export thread every tick_seconds so the
+# caller can send rows that have been waiting too long even while no new records arrive.
+# years can be a single year or a list of years. Every park is searched for every year in one pass, with the years of
+# each park queued next to each other so no year waits on the others, and caching, rate limiting and dedupe are shared
+# across all of them. With a date_range of (start date, end date), only cases filed inside it are handed on. With
+# match_parks, a ParkIndex of the park list picks each park's query and filters broad search hits, learning the
+# plaintiffs of the cases it hands on that were matched to their park. With filter_hits off, the index still picks queries but every hit is kept.
+async def crawl(park_names, years, handle_record, concurrency=4, requests_per_second=0.5, retry_rounds=1, checkpoint=None, resume=False,
+                parse_workers=None, queue_size=32, date_range=None, match_parks=True, reparse=False,
+                tick=None, tick_seconds=5, filter_hits=True):
+    if isinstance(years, int):
+        years = [years]
+    http_client.rate_limiter = TokenBucket(requests_per_second)
+    http_client.configure(connections=concurrency)
+    http_client.take_failed_urls()
+    loop = asyncio.get_running_loop()
+    fetch_executor = ThreadPoolExecutor(max_workers=concurrency)
+    # Parsing runs in separate processes so it can use every core, with parse_workers=0 it runs in a thread instead
+    if parse_workers is None:
+        parse_workers = os.cpu_count() or 1
+    # Worker processes start with an empty metrics registry so nothing copied from this process is counted twice. They are
+    # started by a forkserver rather than forked from this process, whose threads may be holding locks at the time.
+    parse_executor = (ProcessPoolExecutor(max_workers=parse_workers, initializer=metrics.reset,
+                                          mp_context=multiprocessing.get_context('forkserver')) if parse_workers > 0
+                      else ThreadPoolExecutor(max_workers=1))
+    export_executor = ThreadPoolExecutor(max_workers=1)
+    parse_queue = asyncio.Queue(maxsize=queue_size)
+    export_queue = asyncio.Queue(maxsize=queue_size)
+    # Limits how many parks are being worked on at once so results are handed back steadily
+    park_slots = asyncio.Semaphore(concurrency)
+    # Search URLs mapped back to every (park, year, position) that sent them, parks that share a query are all run again
+    # when its search fails
+    parks_by_url = {}
+    # Positions in the park list that are finished for each year, used to move the checkpoint cursors forward
+    finished_positions = {year: set() for year in years}
+    starts = dict.fromkeys(years, 0)
+    # Parks that repeat another park's search are dropped, searches are shared across parks, and each case page is
+    # downloaded at most once per run even when several parks' searches return it
+    park_names = planner.dedupe_parks(park_names)
+    searches = planner.SearchCache()
+    requested_cases = set()
+    parks = park_index.ParkIndex(park_names, checkpoint, filtering=filter_hits) if match_parks else None
+    # The park whose search found each case, so the plaintiffs on the case pages can be added to the park index
+    case_parks = {}
+
+    if checkpoint is not None:
+        for year in years:
+            if resume:
+                starts[year] = checkpoint.cursor(year)
+                print(f'Resuming {year} from park {starts[year] + 1} of {len(park_names)}')
+            else:
+                checkpoint.start_run(year)
+
+    def park_finished(position, park_name, year):
+        if checkpoint is None:
+            return
+        checkpoint.mark_park_searched(year, park_name)
+        finished_positions[year].add(position)
+        cursor = checkpoint.cursor(year)
+        if cursor in finished_positions[year]:
+            while cursor in finished_positions[year]:
+                cursor += 1
+            checkpoint.set_cursor(year, cursor)
+
+    # Download stage, the case is finished once the writer has handled it, so a park is only marked as searched
+    # after every one of its cases has been exported
+    async def crawl_case(case_number):
+        if case_number in requested_cases:
+            metrics.increment('duplicate_cases_skipped')
+            return
+        if checkpoint is not None and not reparse and checkpoint.case_seen(case_number):
+            return
+        requested_cases.add(case_number)
+        try:
+            url = case_url.format(case_number)
+            print('Case Number:', case_number)
+            html = await loop.run_in_executor(fetch_executor, parse_data.get_html, url)
+            if html is None:
+                # Forgotten so the retry pass can request it again
+                requested_cases.discard(case_number)
+                return
+            done = loop.create_future()
+            await parse_queue.put((case_number, url, html, done))
+            await done
+        except Exception as e:
+            tb = traceback.format_exc()
+            print(f"An error occurred: {e}\nTraceback: {tb}")
+
+    # Parse stage, several of these run at once to keep every parsing process busy
+    async def parse_worker():
+        while True:
+            item = await parse_queue.get()
+            if item is None:
+                break
+            case_number, url, html, done = item
+            try:
+                record, parse_metrics = await loop.run_in_executor(parse_executor, parse_case_with_metrics, html, url)
+            except Exception as e:
+                metrics.increment('parse_errors')
+                done.set_exception(e)
+                continue
+            metrics.merge(parse_metrics)
+            await export_queue.put((case_number, record, done))
+
+    # Export stage, a single writer so records are handed to handle_record one at a time
+    async def export_writer():
+        while True:
+            item = await export_queue.get()
+            if item is None:
+                break
+            case_number, record, done = item
+            # Every record resolves its done future, an error here would otherwise leave crawl_case waiting forever
+            try:
+                if date_range is not None and not filed_within(record, *date_range):
+                    metrics.increment('cases_outside_window')
+                    done.set_result(None)
+                    continue
+                with metrics.timer('export_seconds'):
+                    await loop.run_in_executor(export_executor, handle_record, case_number, record)
+                metrics.increment('records_handled')
+                if parks is not None:
+                    parks.learn_plaintiff(case_parks.get(case_number), record.plaintiff, case_number)
+            except Exception as e:
+                done.set_exception(e)
+            else:
+                done.set_result(None)
+
+    async def crawl_park(park_name, year, position=None):
+        if checkpoint is not None and resume and checkpoint.park_searched(year, park_name):
+            finished_positions[year].add(position)
+            return
+        async with park_slots:
+            words = park_name.split()
+            queries = [words, broad_search_words(words)]
+            if parks is not None and parks.best_query(park_name, year) is not None:
+                queries.append(parks.best_query(park_name, year))
+            for query in queries:
+                parks_by_url.setdefault(search_url(query, year), set()).add((park_name, year, position))
+            try:
+                case_numbers = await loop.run_in_executor(fetch_executor, find_case_numbers, park_name, year, searches, parks)
+            except Exception as e:
+                tb = traceback.format_exc()
+                print(f"An error occurred: {e}\nTraceback: {tb}")
+                return
+            if case_numbers:
+                for case_number in case_numbers:
+                    case_parks.setdefault(case_number, park_name)
+                await asyncio.gather(*(crawl_case(case_number) for case_number in case_numbers))
+            if case_numbers is not None and position is not None:
+                park_finished(position, park_name, year)
+
+    parsers = [asyncio.create_task(parse_worker()) for _ in range(max(parse_workers, 1) * 2)]
+    writer = asyncio.create_task(export_writer())
+
+    # Runs on the export thread so it never overlaps with handle_record
+    async def ticker():
+        while True:
+            await asyncio.sleep(tick_seconds)
+            try:
+                await loop.run_in_executor(export_executor, tick)
+            except Exception as e:
+                tb = traceback.format_exc()
+                print(f"An error occurred: {e}\nTraceback: {tb}")
+
+    ticks = asyncio.create_task(ticker()) if tick is not None else None
+    try:
+        await asyncio.gather(*(crawl_park(park_names[position], year, position)
+                               for position in range(len(park_names)) for year in years if position >= starts[year]))
+
+        for _ in range(retry_rounds):
+            failed_urls = http_client.take_failed_urls()
+            if not failed_urls:
+                break
+            print(f"Retrying {len(failed_urls)} failed pages")
+            retry_parks = set()
+            for url in failed_urls:
+                retry_parks.update(parks_by_url.get(url, ()))
+            retry_cases = {case_number_from_url(url) for url in failed_urls if 'CaseInfo' in url}
+            await asyncio.gather(*(crawl_park(park_name, year, position) for park_name, year, position in retry_parks),
+                                 *(crawl_case(case_number) for case_number in retry_cases))
+
+        for url in http_client.failed_urls:
+            print('Could not download:', url)
+            for park_name, year, position in sorted(parks_by_url.get(url, ()), key=str):
+                print(f'  {park_name} ({year}) was not searched')
+    finally:
+        for _ in parsers:
+            await parse_queue.put(None)
+        await asyncio.gather(*parsers, return_exceptions=True)
+        await export_queue.put(None)
+        await writer
+        if ticks is not None:
+            ticks.cancel()
+            await asyncio.gather(ticks, return_exceptions=True)
+        fetch_executor.shutdown(wait=True)
+        parse_executor.shutdown(wait=True)
+        export_executor.shutdown(wait=True)
+
+
+# Downloads a known case page again, returning its CaseRecord, or None when the page has not changed since the last refresh,
+# along with the page's new (etag, last_modified, hash) validators, or None when there are none to save. The page is
+# requested with the ETag and Last-Modified value from the last refresh, and when the server doesn't support those the
+# hash of the page is compared instead, so an unchanged page is never parsed again.
+def refresh_case(case_number, validators):
+    etag, last_modified, content_hash = validators
+    url = case_url.format(case_number)
+    print('Refreshing Case Number:', case_number)
+    with metrics.timer('download_seconds'):
+        response = http_client.fetch_response(url, http_client.conditional_headers(etag, last_modified))
+    if response is None:
+        return None, None
+    if response.status_code == 304:
+        metrics.increment('refresh_not_modified')
+        return None, None
+
+    html = response.text
+    page_cache.put(url, html)
+    new_hash = hashlib.sha1(html.encode('utf-8')).hexdigest()
+    new_validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'), new_hash)
+    if new_hash == content_hash:
+        metrics.increment('refresh_same_content')
+        return None, new_validators
+    return parse_data.parse_case_html(html, url), new_validators
+
+
+# Refreshes known cases, given as (case_number, validators) pairs, without searching for any parks. Pages are always
+# downloaded rather than read from the cache, and handle_record is only called for pages that changed, one at a time. The
+# new validators of a changed page are only saved once handle_record has taken its record, so a failed export is retried
+# by the next refresh.
+async def refresh(cases, handle_record, concurrency=4, requests_per_second=0.5, checkpoint=None):
+    http_client.rate_limiter = TokenBucket(requests_per_second)
+    http_client.configure(connections=concurrency)
+    http_client.take_failed_urls()
+    loop = asyncio.get_running_loop()
+    fetch_executor = ThreadPoolExecutor(max_workers=concurrency)
+    export_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def refresh_one(case_number, validators):
+        try:
+            record, new_validators = await loop.run_in_executor(fetch_executor, refresh_case, case_number, validators)
+            if record is not None:
+                with metrics.timer('export_seconds'):
+                    await loop.run_in_executor(export_executor, handle_record, case_number, record)
+                metrics.increment('records_handled')
+            if checkpoint is not None and new_validators is not None:
+                checkpoint.set_page_validators(case_number, *new_validators)
+        except Exception as e:
+            tb = traceback.format_exc()
+            print(f"An error occurred: {e}\nTraceback: {tb}")
+
+    try:
+        await asyncio.gather(*(refresh_one(case_number, validators) for case_number, validators in cases))
+        for url in http_client.take_failed_urls():
+            print('Could not download:', url)
+    finally:
+        fetch_executor.shutdown(wait=True)
+        export_executor.shutdown(wait=True)
@@ -0,0 +1,202 @@
+"""Structured extraction of case data from the html of a case page. Instead of flattening the page into one long list of
+words, the page is broken into its text cells, each piece of text that sits in its own element, in the order they appear.
+Labels like "Party Name" and "Relationship" and the amount descriptions each sit in their own cell, so fields are found
+by looking for those labels rather than by counting words, and names that span several words stay together. The fields
+and the labels they are found by are listed in field_spec. The html is read with the fastest parser that is installed,
+selectolax, then lxml, falling back to the html.parser used by BeautifulSoup."""
+
+import re
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+    backend = 'selectolax'
+except ImportError:
+    try:
+        from lxml import etree
+        backend = 'lxml'
+    except ImportError:
+        from bs4 import BeautifulSoup
+        backend = 'html.parser'
+
+# Elements whose text is never shown on the page
+skip_tags = ['script', 'style', 'noscript', 'template']
+
+# Each field is found by the heading of its section or by its label, party names end at the label given by until
+field_spec = {
+    'plaintiff': {'heading': 'Plaintiff', 'label': 'Party Name', 'until': 'Relationship', 'many': False},
+    'defendants': {'heading': 'Defendant', 'label': 'Party Name', 'until': 'Relationship', 'many': True},
+    'judgments': {'heading': 'Judgments', 'none_text': 'There are no judgments'},
+    'file_date': {'label': 'File Date'},
+}
+
+# Headings of the search results table columns that are read
+search_columns = {'case_number': 'Case Number', 'party': 'Party Name'}
+
+# The first word of the description next to a dollar amount decides which charge the amount belongs to
+amount_fields = {
+    'Total': 'total_judgment',
+    'Attorney': 'attorney_fees',
+    'Costs': 'costs',
+    'Utilities': 'utilities',
+    'Undesignated': 'undesignated',
+    'Tax': 'tax',
+    'Notice': 'notice_fees',
+    'Late': 'late_charge',
+    'Rent': 'rent',
+}
+
+date_pattern = re.compile(r"\d{1,2}/\d{1,2}/\d{4}")
+
+
+# This function returns every piece of visible text on the page in order, with surrounding whitespace removed
+def text_cells(html):
+    if not html:
+        return []
+
+    if backend == 'selectolax':
+        tree = LexborHTMLParser(html)
+        tree.strip_tags(skip_tags)
+        pieces = (node.text(deep=False) for node in tree.root.traverse(include_text=True) if node.tag == '-text')
+    elif backend == 'lxml':
+        root = etree.fromstring(html, etree.HTMLParser(remove_comments=True, remove_pis=True))
+        if root is None:
+            return []
+        etree.strip_elements(root, *skip_tags, with_tail=False)
+        pieces = root.itertext()
+    else:
+        soup = BeautifulSoup(html, 'html.parser')
+        for element in soup(skip_tags):
+            element.decompose()
+        pieces = soup.strings
+
+    cells = []
+    for piece in pieces:
+        piece = piece.strip()
+        if piece:
+            cells.append(piece)
+    return cells
+
+
+# Labels are sometimes followed by a colon, this removes it so they can be compared
+def label(cell):
+    return cell.rstrip(':').strip()
+
+
+# Finds the names in every section that starts with the given heading followed by the name label
+def find_parties(cells, spec):
+    names = []
+    for index in range(len(cells) - 1):
+        if cells[index] == spec['heading'] and label(cells[index + 1]) == spec['label']:
+            name = []
+            for cell in cells[index + 2:]:
+                if label(cell) == spec['until']:
+                    break
+                name.append(cell)
+            name = ' '.join(' '.join(name).split())
+            if name:
+                names.append(name)
+                if not spec['many']:
+                    break
+    return names
+
+
+# Finds whether there are judgments on the case and the date of the first one
+def find_judgments(cells, spec):
+    for index, cell in enumerate(cells):
+        if cell == spec['heading']:
+            following = cells[index + 1:]
+            if following and following[0].startswith(spec['none_text']):
+                return 'N', 'N/A'
+            for next_cell in following:
+                match = date_pattern.search(next_cell)
+                if match:
+                    return 'Y', match.group(0)
+            return None
+    return None
+
+
+# Finds the first date in the cells that follow a label, or None if the label isn't on the page
+def find_labelled_date(cells, spec):
+    for index, cell in enumerate(cells):
+        if label(cell) == spec['label']:
+            for next_cell in cells[index + 1:index + 3]:
+                match = date_pattern.search(next_cell)
+                if match:
+                    return match.group(0)
+            return None
+    return None
+
+
+# Turns a dollar amount like $1,250.00 or ($45.00) into a number
+def parse_amount(text):
+    return float(text.replace('$', '').replace(',', '').replace('(', '').replace(')', ''))
+
+
+# This function sorts dollar amounts into charges in a single pass. It takes (amount, description) pairs, where the
+# description is the word that follows the amount, and stops at the total just like the page does.
+def classify_amounts(pairs):
+    totals = dict.fromkeys(amount_fields.values(), 0)
+    for amount, description in pairs:
+        field = amount_fields.get(description)
+        if field is None:
+            continue
+        totals[field] += parse_amount(amount)
+        if field == 'total_judgment':
+            break
+
+    total_amount = sum(totals.values())
+    return (total_amount, totals['rent'], totals['attorney_fees'], totals['tax'], totals['utilities'], totals['late_charge'],
+            totals['notice_fees'], totals['costs'], totals['undesignated'])
+
+
+# Pairs each dollar amount cell with the first word of its description, which is either in the same cell or the next one
+def amount_pairs(cells):
+    for index, cell in enumerate(cells):
+        if '$' not in cell:
+            continue
+        words = cell.split()
+        if len(words) > 1:
+            yield words[0], words[1]
+        elif index + 1 < len(cells):
+            yield cell, cells[index + 1].split()[0]
+
+
+# Finds the case numbers in the text cells of a search results page, each paired with its party name. The party name is
+# taken from the column headed "Party Name" in the results table rather than assumed to follow the case number, and is
+# None when the table has no such heading or the row's cell is empty, since a hit without a name is never filtered out.
+def search_hits(cells):
+    rows = [index for index, cell in enumerate(cells) if cell.startswith('CC') and len(cell.split()) == 1]
+    if not rows:
+        return []
+    # The table headings are the last cells before the first case number, read backwards so a search form above the
+    # table with the same labels isn't picked up. The party column is counted from the case number column.
+    header = cells[:rows[0]][::-1]
+    offset = None
+    if search_columns['case_number'] in header and search_columns['party'] in header:
+        offset = header.index(search_columns['case_number']) - header.index(search_columns['party'])
+
+    hits = []
+    for position, index in enumerate(rows):
+        row_end = rows[position + 1] if position + 1 < len(rows) else len(cells)
+        party = None
+        # Empty cells are left out of the text cells, so a cell past the end of the row or holding a date belongs to
+        # another column
+        if offset is not None and offset > 0 and index + offset < row_end:
+            party = cells[index + offset]
+            if date_pattern.fullmatch(party):
+                party = None
+        hits.append((cells[index], party))
+    return hits
+
+
+# This function pulls every field it can find from the text cells of a case page, fields that could not be found are None
+def extract_fields(cells):
+    plaintiff = find_parties(cells, field_spec['plaintiff'])
+    defendants = find_parties(cells, field_spec['defendants'])
+    return {
+        'plaintiff': plaintiff[0] if plaintiff else None,
+        'defendants': defendants if defendants else None,
+        'judgments': find_judgments(cells, field_spec['judgments']),
+        'amounts': classify_amounts(amount_pairs(cells)),
+        'file_date': find_labelled_date(cells, field_spec['file_date']),
+    }
@@ -0,0 +1,167 @@
+"""Shared HTTP session used for every download from the court site. A single requests session keeps connections to the
+site open between requests, so each page doesn't pay for a new connection and TLS handshake. Requests that fail because
+of a network error or a busy server are retried with a growing, randomized delay, and when the server sends a Retry-After
+header that delay is used instead. A Retry-After longer than backoff_cap is never cut short, the URL is given up on
+straight away rather than asked for again before the server is ready. URLs that still fail after every retry are put in
+a retry queue so the crawler can try them again at the end of the run instead of losing them. Pages that were
+downloaded before can be requested conditionally with their ETag or Last-Modified value, so an unchanged page costs a
+304 response instead of the whole page. requests is only imported once the first page is downloaded, so work that
+never touches the network starts faster."""
+
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import metrics
+
+# Seconds to wait for a connection and for the server to respond
+connect_timeout = 10
+read_timeout = 30
+
+# Number of times a request is retried after the first attempt
+max_retries = 4
+
+# Delays between retries start at backoff_base seconds and double each time, up to backoff_cap seconds
+backoff_base = 2
+backoff_cap = 120
+
+# Number of connections kept open to the court site
+pool_size = 8
+
+# Status codes that mean the server is busy or having trouble and the request should be tried again
+retry_statuses = {429, 500, 502, 503, 504}
+
+# Set by the crawler to limit how often the court site is contacted, every request takes a token from it first
+rate_limiter = None
+
+# URLs that failed after every retry, waiting to be tried again
+failed_urls = deque()
+
+session = None
+session_lock = threading.Lock()
+
+
+# This function changes the client settings, any setting left as None keeps its current value
+def configure(connect_seconds=None, read_seconds=None, retries=None, connections=None):
+    global connect_timeout, read_timeout, max_retries, pool_size, session
+    if connect_seconds is not None:
+        connect_timeout = connect_seconds
+    if read_seconds is not None:
+        read_timeout = read_seconds
+    if retries is not None:
+        max_retries = retries
+    if connections is not None:
+        pool_size = connections
+        # The pool size is set when the session is created, so a new one is needed
+        session = None
+
+
+# The session is created the first time it is needed and then shared by every thread
+def get_session():
+    global session
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            session.verify = False
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
+
+
+# The Retry-After header can be a number of seconds or a date
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Delay before the next attempt, full jitter keeps many workers from retrying at the same moment. The server's
+# Retry-After is returned as it is, even when it is longer than backoff_cap.
+def retry_delay(attempt, response=None):
+    if response is not None:
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if retry_after is not None:
+            return retry_after
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+
+# Headers that ask the server to only send the page if it changed since it was last downloaded
+def conditional_headers(etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+# This function downloads a page and returns the response, or None if it could not be downloaded. A 304 Not Modified
+# response to a conditional request is returned like a successful one.
+def fetch_response(url, headers=None):
+    import requests
+
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        response = None
+        metrics.increment('http_requests')
+        try:
+            with metrics.timer('http_request_seconds'):
+                response = get_session().get(url, headers=headers, timeout=(connect_timeout, read_timeout))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.increment('http_errors', kind=type(e).__name__)
+            print(f"Request failed: {e}")
+        else:
+            metrics.increment('http_responses', status=response.status_code)
+            if response.status_code in (200, 304):
+                return response
+            if response.status_code not in retry_statuses:
+                print(f"Failed to retrieve webpage. Status code: {response.status_code}")
+                return None
+            print(f"Server busy. Status code: {response.status_code}")
+
+        if attempt < max_retries:
+            delay = retry_delay(attempt, response)
+            # Waiting this long would hold up a worker thread, the URL goes to the retry queue instead
+            if delay > backoff_cap:
+                metrics.increment('http_retry_after_too_long')
+                print(f"Server asked to wait {delay:.0f} seconds before retrying {url}")
+                break
+            metrics.increment('http_retries')
+            metrics.observe('retry_sleep_seconds', delay)
+            time.sleep(delay)
+
+    metrics.increment('http_gave_up')
+    print(f"Giving up on {url} after {attempt + 1} attempts, added to the retry queue")
+    failed_urls.append(url)
+    return None
+
+
+# This function downloads a page and returns its html, or None if it could not be downloaded
+def fetch(url):
+    response = fetch_response(url)
+    if response is None:
+        return None
+    return response.text
+
+
+# Removes and returns every URL currently in the retry queue
+def take_failed_urls():
+    urls = []
+    while failed_urls:
+        urls.append(failed_urls.popleft())
+    return urls
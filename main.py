@@ -1,187 +1,267 @@
 '''This is the main script to be ran, it works by generating URLs based off mobile home park names and case numbers. The URLs
 are generated and verification is done to determine if desirable data is present within the web page. It then calls the
-functions in parse_data to pull the data, compile them into a dataframe, and send them to a google sheet for the client.'''
+functions in parse_data to pull the data, buffer them into batches, and send them to a google sheet for the client.'''
 
-import gspread
-from gspread_dataframe import set_with_dataframe
-import time
+import asyncio
+import csv
+import os
+import socket
 import traceback
-import pandas as pd
 import warnings
 
-import parse_data
+import checkpoint
+import crawler
+import metrics
+import shards
+import sinks
 
 warnings.filterwarnings("ignore")
 
-# This function is used when sending data to the google sheet, making sure it is sent to the next empty row
-def find_next_empty_row(sheet):
-    col_values = sheet.col_values(1)
-    
-    next_empty_row = col_values.index('') + 1 if '' in col_values else len(col_values) + 1
-    
-    return next_empty_row
-    
+# This function turns a CaseRecord into a row for the google sheet, or None if the case has no defendants
+def build_row(case_number, record):
+    if not record.defendants:
+        return None
+    if record.judgments is None:
+        raise ValueError('No judgment section found on case page')
+
+    hyperlink_formula = f'=HYPERLINK("{record.url}", "{case_number}")'
+    # Multiple defendants are combined into a single cell
+    defendants = ', '.join(record.defendants)
+
+    return {
+        'plaintiff': record.plaintiff,
+        'hyperlink_formula': hyperlink_formula,
+        'defendants': defendants,
+        'judgments': record.judgments,
+        'judgment_date': record.judgment_date,
+        'total_amount': record.total_amount,
+        'rent': record.rent,
+        'attorney_fees': record.attorney_fees,
+        'tax': record.tax,
+        'utilities': record.utilities,
+        'late_charge': record.late_charge,
+        'notice_fees': record.notice_fees,
+        'costs': record.costs,
+        'undesignated': record.undesignated
+    }
+
+
+# Configuration file for google cloud api is required when reading from or sending to the google sheet, set by cli.py
+cred_file = None
+
+
+# Opens the google file with the park list data and the sheets for data to be sent to
+def open_sheet(sheet_id):
+    import gspread
+
+    if cred_file is None:
+        raise ValueError('No google cloud credentials file was given')
+    gc = gspread.service_account(cred_file)
+    return gc.open(sheet_id)
 
 
-def get_url(year, sheet_id, park_list, sheet_name):
+# Reads the park list from a local file, one park per line with a header line first, the same layout as the park list sheet
+def read_park_file(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return [row[0] for row in list(csv.reader(f))[1:] if row and row[0].strip()]
 
-    # Configuration file for google cloud api is required for this script to work
-    cred_file = "your_google_cloud_json_file"
-    gc = gspread.service_account(cred_file)
 
-    # Google file with park list data and sheets for data to be sent to
-    park_data = gc.open(sheet_id)
+# Opens the output rows are sent to. With dedupe, the rows already in the output are read once into a lead index so only
+# new or changed leads are written. The google file is opened here unless one that is already open is given. pandas is
+# only imported when the lead index is needed.
+def open_output(output, output_path, sheet_id, sheet_name, spreadsheet=None, dedupe=True, **kwargs):
+    if dedupe:
+        import postprocess
 
-    # List of mobile home parks
-    park_list_sheet = park_data.worksheet(park_list)
+    if output == 'sheet':
+        worksheet = (spreadsheet or open_sheet(sheet_id)).worksheet(sheet_name)
+        leads = postprocess.LeadIndex.from_sheet(worksheet) if dedupe else None
+        return sinks.SheetSink(worksheet, leads=leads, **kwargs)
+    leads = None
+    if dedupe:
+        leads = postprocess.LeadIndex.from_rows(sinks.read_rows(output, output_path) if os.path.exists(output_path) else [])
+    return sinks.open_sink(output, output_path, leads=leads, **kwargs)
 
-    column_1_values = park_list_sheet.col_values(1)[1:]
 
-    # URL template used to generate new URLs for each court case search
-    base_url = "https://justicecourts.maricopa.gov/app/courtrecords/caseSearchResults?bName="
+# year can be a single year or a list of years, all of them are crawled together in one pass. With a date_range of
+# (start date, end date) every year it covers is searched and only cases filed inside it are kept. With shard given as
+# (shard, shard count) only the parks of that shard are crawled.
+def get_url(year, sheet_id, park_list, sheet_name, concurrency=4, requests_per_second=0.5, checkpoint_path=checkpoint.default_path, resume=False,
+            batch_size=20, output='sheet', output_path=None, park_file=None, parse_workers=None, metrics_json=None, metrics_prom=None,
+            date_range=None, shard=None, dedupe=True, lead_totals=None, reparse=False, filter_hits=True):
+    metrics.reset()
 
-    # Generate dataframe used to send data
-    df = pd.DataFrame(columns=['plaintiff', 'hyperlink_formula', 'defendants', 'judgments', 'judgment_date', 'total_amount', 'rent', 'attorney_fees', 'tax', 'utilities', 'late_charge', 'notice_fees', 'costs', 'undesignated'])
+    # The google file is only opened if the park list or the output needs it
+    park_data = None
+    if park_file is None or output == 'sheet':
+        park_data = open_sheet(sheet_id)
 
+    # List of mobile home parks
+    if park_file is not None:
+        column_1_values = read_park_file(park_file)
+    else:
+        park_list_sheet = park_data.worksheet(park_list)
+        column_1_values = park_list_sheet.col_values(1)[1:]
+    if shard is not None:
+        column_1_values = shards.shard_parks(column_1_values, *shard)
+        print(f'Shard {shard[0]} of {shard[1]}: {len(column_1_values)} parks')
+
+    # Progress is saved locally so a crash doesn't lose work and already seen cases aren't downloaded again
+    store = checkpoint.Checkpoint(checkpoint_path)
+
+    # Rows are buffered and sent in batches to limit api calls and memory use, each sent batch is marked in the checkpoint
+    sink = open_output(output, output_path, sheet_id, sheet_name, spreadsheet=park_data, dedupe=dedupe, flush_rows=batch_size,
+                       on_flush=store.mark_exported)
+
+    # Start with any rows a previous run built but never sent
+    for case_number, row in store.pending_rows():
+        sink.add(case_number, row)
+
+    # Called by the crawler's export writer with the data pulled from each case, one case at a time
+    def handle_record(case_number, record):
+        row = build_row(case_number, record)
+        if row is None:
+            store.mark_case_skipped(case_number)
+            return
+        store.add_pending(case_number, row)
+        print('Plaintiff:', row['plaintiff'])
+        print('Defendants:', row['defendants'])
 
-    for value in column_1_values:
         try:
-            # Check to see length of data, data is sent in batches of 20 to limit api calls
-            if len(df) >= 20:
-                    sheet = park_data.worksheet(sheet_name)
-                    next_empty_row = find_next_empty_row(sheet)
-                    set_with_dataframe(sheet, df, row=next_empty_row, include_index=False, include_column_header=False)
-                    df.drop(df.index, inplace=True)
-                    print()
-                    print('Data Sent')
-                    print()
-
-
-
-            # Delays are present throughout the script to prevent api limits from being reached
-            time.sleep(12)
-
-            # Split name of mobile home park pulled from list into seperate words
-            words = value.split()
-            
-            # Reset url to base url for each new search
-            url = base_url
-
-            # Iterate through mobile home park name and add them to search URL
-            for i in range(len(words)):
-                name_in_url = words[i] + '%20'
-                url += name_in_url
-
-            url = url.rstrip('%20')
-            url = url + f'&year={year}'
-
-
-            print('URL:', url)
-            # Generate list of case numbers from search URL, each mobile home park is typically involved in multiple cases
-            case_numbers = parse_data.get_case_numbers(url)
-            if case_numbers is not None:
-                # If no case numbers are returned, retry search with certain keywords removed, removing these words allows for a broader search
-                if len(case_numbers) == 0:
-                    words = [element.lower() for element in words]
-                    new_words = [word for word in words if word not in ['mobile', 'rv', 'park', 'home', 'subdivision', 'resort', 'estate', 'estates', 'community', 'trailer']]
-
-
-                    url = base_url
-                    for i in range(len(new_words)):
-                        name_in_url = new_words[i] + '%20'
-                        url += name_in_url
-
-                    url = url.rstrip('%20')
-                    url = url + f'&year={year}'
-                    case_numbers = parse_data.get_case_numbers(url)
-
-                # If case numbers are returned, these are used to generate new URLs for each case, where the data sent to the google sheet is pulled from
-                if len(case_numbers) > 0:
-                    time.sleep(12)
-                    for i in range(len(case_numbers)):
-                        try:
-                            # Generate new URL using case numbers
-                            print('Case Number:', case_numbers[i])
-                            url = f"https://justicecourts.maricopa.gov/app/courtrecords/CaseInfo?casenumber={case_numbers[i]}" + "000"
-                            link_text = f"{case_numbers[i]}"
-                            hyperlink_formula = f'=HYPERLINK("{url}", "{link_text}")'
-                            print(url)
-                            # Pull desired data from generated URLs
-                            plaintiff = parse_data.get_plaintiff(url)
-                            defendants = parse_data.get_defendants(url)
-                            if defendants is not None:
-                                judgments, judgment_date = parse_data.get_judgments(url)
-                                total_amount, rent, attorney_fees, tax, utilities, late_charge, notice_fees, costs, undesignated = parse_data.get_amounts(url)
-                                if len(defendants) > 0:
-                                    if len(defendants) > 1:
-                                        names_list = defendants
-                                        defendants = ', '.join(names_list)
-                                        if isinstance(defendants, list) and all(isinstance(item, (int, float, str)) for item in defendants):
-                                            pass
-                                        else:
-                                            defendants = [defendants]
-                                        # Generate datafram with data to be sent to google sheet
-                                        new_data = pd.DataFrame({
-                                            'plaintiff': [plaintiff],
-                                            'hyperlink_formula': hyperlink_formula,
-                                            'defendants': [defendants[-1]],
-                                            'judgments': [judgments],
-                                            'judgment_date': [judgment_date],
-                                            'total_amount': [total_amount],
-                                            'rent': [rent],
-                                            'attorney_fees': [attorney_fees],
-                                            'tax': [tax],
-                                            'utilities': [utilities],
-                                            'late_charge': [late_charge],
-                                            'notice_fees': [notice_fees],
-                                            'costs': [costs],
-                                            'undesignated': [undesignated]
-                                        })
-
-                                        df = pd.concat([df, new_data], ignore_index=True)
-
-                                        print('Plaintiff:', plaintiff)
-                                        print('Defendants:', defendants)
-                                    else:
-                                        
-                                        new_data = pd.DataFrame({
-                                            'plaintiff': [plaintiff],
-                                            'hyperlink_formula': hyperlink_formula,
-                                            'defendants': [defendants[-1]],
-                                            'judgments': [judgments],
-                                            'judgment_date': [judgment_date],
-                                            'total_amount': [total_amount],
-                                            'rent': [rent],
-                                            'attorney_fees': [attorney_fees],
-                                            'tax': [tax],
-                                            'utilities': [utilities],
-                                            'late_charge': [late_charge],
-                                            'notice_fees': [notice_fees],
-                                            'costs': [costs],
-                                            'undesignated': [undesignated]
-                                        })
-
-                                        df = pd.concat([df, new_data], ignore_index=True)
-
-                                        print('Plaintiff:', plaintiff)
-                                        print('Defendants:', defendants[-1])
-                                
-                        except Exception as e:
-                            tb = traceback.format_exc()
-                            print(f"An error occurred: {e}\nTraceback: {tb}")
-                            time.sleep(60)
-                            continue
-                
+            sink.add(case_number, row)
         except Exception as e:
             tb = traceback.format_exc()
             print(f"An error occurred: {e}\nTraceback: {tb}")
-            time.sleep(60)
-            continue
+
+    # Searches and case downloads run concurrently, the crawler keeps requests under the given rate
+    try:
+        years = crawler.years_between(*date_range) if date_range is not None else year
+        asyncio.run(crawler.crawl(column_1_values, years, handle_record, concurrency=concurrency, requests_per_second=requests_per_second,
+                                  checkpoint=store, resume=resume, parse_workers=parse_workers, date_range=date_range,
+                                  reparse=reparse, tick=sink.flush_if_due, filter_hits=filter_hits))
+
+        # Send whatever is left once every park has been searched
+        sink.close()
+        if lead_totals is not None and sink.leads is not None:
+            sink.leads.write_totals(lead_totals)
+    finally:
+        store.close()
+
+        # Save the run report so slow runs can be traced to the network, parsing, waits or sheet writes
+        if metrics_json is not None:
+            metrics.write_json(metrics_json)
+        if metrics_prom is not None:
+            metrics.write_prometheus(metrics_prom)
+
+
+# This function revisits the open cases in the checkpoint, the ones without a judgment yet, and replaces the rows of those
+# whose data changed. Unchanged pages are skipped without being parsed, so a daily refresh costs far less than a crawl.
+def refresh_cases(sheet_id, sheet_name, concurrency=4, requests_per_second=0.5, checkpoint_path=checkpoint.default_path, batch_size=20,
+                  output='sheet', output_path=None, metrics_json=None, metrics_prom=None, dedupe=True):
+    metrics.reset()
+    store = checkpoint.Checkpoint(checkpoint_path)
+    sink = open_output(output, output_path, sheet_id, sheet_name, dedupe=dedupe, flush_rows=batch_size, on_flush=store.mark_exported)
+
+    # Start with any changed rows a previous refresh never sent
+    for case_number, row in store.changed_rows():
+        sink.replace(case_number, row)
+
+    open_cases = store.open_cases()
+    known_rows = {case_number: row for case_number, row, validators in open_cases}
+    print(f'Refreshing {len(open_cases)} open cases')
+
+    def handle_record(case_number, record):
+        row = build_row(case_number, record)
+        # Only rows whose fields actually changed are sent
+        if row is None or row == known_rows[case_number]:
+            metrics.increment('refresh_unchanged')
+            return
+        store.mark_changed(case_number, row)
+        print('Updated:', case_number, 'Judgment:', row['judgments'], row['judgment_date'])
+        metrics.increment('refresh_updated')
+        sink.replace(case_number, row)
+
+    try:
+        asyncio.run(crawler.refresh([(case_number, validators) for case_number, row, validators in open_cases], handle_record,
+                                    concurrency=concurrency, requests_per_second=requests_per_second, checkpoint=store))
+        sink.close()
+    finally:
+        store.close()
+        if metrics_json is not None:
+            metrics.write_json(metrics_json)
+        if metrics_prom is not None:
+            metrics.write_prometheus(metrics_prom)
+
+
+# Crawls one shard of the park list, its output, checkpoint and run report get their own files named after the shard
+def run_shard(year, sheet_id, park_list, shard, shard_count, output='csv', output_path='leads.csv', checkpoint_path=checkpoint.default_path,
+              metrics_json=None, metrics_prom=None, **kwargs):
+    if output == 'sheet':
+        raise ValueError('Shards write to local files, pick a local --output and send the merged rows to the sheet with --merge')
+    get_url(year, sheet_id, park_list, None, output=output, output_path=shards.shard_path(output_path, shard, shard_count),
+            checkpoint_path=shards.shard_path(checkpoint_path, shard, shard_count),
+            metrics_json=shards.shard_path(metrics_json, shard, shard_count) if metrics_json is not None else None,
+            metrics_prom=shards.shard_path(metrics_prom, shard, shard_count) if metrics_prom is not None else None,
+            shard=(shard, shard_count), **kwargs)
+
+
+# Worker loop for a sharded crawl, it claims shards from the ledger and crawls them until none are left. Any number of
+# workers can run this at once, on one machine or on several that share the ledger's directory.
+def run_shard_worker(year, sheet_id, park_list, shard_count, ledger_path=shards.default_ledger, resume=False, **kwargs):
+    ledger = shards.Ledger(ledger_path, shard_count)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    try:
+        while True:
+            claim = ledger.claim(worker)
+            if claim is None:
+                print('No shards left to crawl')
+                break
+            shard, reclaimed = claim
+            print(f'{worker} crawling shard {shard} of {shard_count}')
+            try:
+                # A shard taken over from a worker that stopped picks up from that worker's checkpoint
+                with shards.lease_kept(ledger_path, shard, worker):
+                    run_shard(year, sheet_id, park_list, shard, shard_count, resume=resume or reclaimed, **kwargs)
+            except BaseException:
+                ledger.release(shard, worker)
+                raise
+            if not ledger.finish(shard, worker):
+                print(f'Shard {shard} was taken over by another worker before {worker} finished it, leaving it to them')
+    finally:
+        ledger.close()
+
+
+# This function combines the output of every shard, dropping cases found by more than one shard, and sends the rows to the
+# google sheet, or to a local file of the same kind when merge_path is given
+def merge_shards(kind, output_path, shard_count, sheet_id, sheet_name, merge_path=None, ledger_path=shards.default_ledger, batch_size=500,
+                 dedupe=True):
+    if os.path.exists(ledger_path):
+        ledger = shards.Ledger(ledger_path)
+        for shard, status, worker in ledger.unfinished():
+            print(f'Warning: shard {shard} is {status}' + (f' by {worker}' if worker else '') + ', its rows may be incomplete')
+        ledger.close()
+
+    rows = shards.merge_rows(kind, output_path, shard_count)
+    print(f'Merged {len(rows)} cases from {shard_count} shards')
+    sink = open_output('sheet' if merge_path is None else kind, merge_path, sheet_id, sheet_name, dedupe=dedupe, flush_rows=batch_size)
+    for case_number, row in rows:
+        sink.add(case_number, row)
+    sink.close()
+
+
+# This function sends rows saved by a local sink to the google sheet, used after a backfill to local storage. With dedupe
+# only rows that aren't already in the sheet, or that changed, are sent.
+def push_to_sheet(kind, path, sheet_id, sheet_name, batch_size=500, dedupe=True):
+    sink = open_output('sheet', None, sheet_id, sheet_name, dedupe=dedupe, flush_rows=batch_size)
+    for case_number, row in sinks.read_rows(kind, path):
+        sink.add(case_number, row)
+    sink.close()
 
 
 
 if __name__ == '__main__':
-    sheet_id = 'EVICTION records - Chaparral A MHP'
-    park_list = 'Park List'
-    sheet_name = 'Data 1/28'
-    get_url(2025, sheet_id, park_list, sheet_name)
\ No newline at end of file
+    # The command line lives in cli.py, python main.py works the same as python cli.py
+    import sys
+
+    import cli
+    cli.main(sys.argv[1:])
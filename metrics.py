@@ -0,0 +1,163 @@
+"""Counters and latency histograms collected while a run is going, so a slow run can be traced to the network, parsing,
+rate limit waits or sheet writes. Timing hooks throughout the program record into a single registry, which can be saved
+as a JSON run summary or as a Prometheus text file. Each metric can carry labels, like the status code of a response.
+Parsing runs in separate processes, each process records into its own registry and the crawler merges them back in."""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets in seconds, the last bucket catches everything slower
+buckets = [0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')]
+
+lock = threading.Lock()
+counters = {}
+histograms = {}
+started = time.time()
+
+
+# Metrics are stored under their name and their labels in a fixed order
+def metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    key = metric_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+# Records one measurement, in seconds, in a histogram
+def observe(name, seconds, **labels):
+    key = metric_key(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(buckets)}
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+        for index, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram['buckets'][index] += 1
+                break
+
+
+# Times the code inside the with block and records it in a histogram
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+# Clears every metric, used at the start of a run
+def reset():
+    global started
+    with lock:
+        counters.clear()
+        histograms.clear()
+        started = time.time()
+
+
+# Returns everything recorded so far and clears it, used by the parsing processes to send their metrics back
+def drain():
+    with lock:
+        snapshot = (dict(counters), {key: dict(value, buckets=list(value['buckets'])) for key, value in histograms.items()})
+        counters.clear()
+        histograms.clear()
+    return snapshot
+
+
+# Adds metrics drained from another process into this registry
+def merge(snapshot):
+    other_counters, other_histograms = snapshot
+    with lock:
+        for key, value in other_counters.items():
+            counters[key] = counters.get(key, 0) + value
+        for key, other in other_histograms.items():
+            histogram = histograms.get(key)
+            if histogram is None:
+                histograms[key] = dict(other, buckets=list(other['buckets']))
+                continue
+            histogram['count'] += other['count']
+            histogram['sum'] += other['sum']
+            histogram['max'] = max(histogram['max'], other['max'])
+            histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+
+
+# Estimates a percentile from the histogram buckets, the answer is the upper bound of the bucket it falls in
+def percentile(histogram, fraction):
+    target = histogram['count'] * fraction
+    seen = 0
+    for bound, count in zip(buckets, histogram['buckets']):
+        seen += count
+        if seen >= target:
+            return min(bound, histogram['max'])
+    return histogram['max']
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+# The run summary as a dictionary that can be saved as JSON
+def summary():
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, dict(value)) for key, value in histograms.items())
+    report = {'started': started, 'elapsed_seconds': time.time() - started, 'counters': {}, 'latency': {}}
+    for (name, labels), value in counter_items:
+        report['counters'][name + label_text(labels)] = value
+    for (name, labels), histogram in histogram_items:
+        report['latency'][name + label_text(labels)] = {
+            'count': histogram['count'],
+            'total_seconds': histogram['sum'],
+            'mean_seconds': histogram['sum'] / histogram['count'] if histogram['count'] else 0,
+            'p50_seconds': percentile(histogram, 0.5),
+            'p95_seconds': percentile(histogram, 0.95),
+            'max_seconds': histogram['max'],
+        }
+    return report
+
+
+def write_json(path):
+    with open(path, 'w') as f:
+        json.dump(summary(), f, indent=2)
+
+
+# Writes every metric in the Prometheus text format, for the node exporter's textfile collector
+def write_prometheus(path, prefix='lead_gen_'):
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, dict(value)) for key, value in histograms.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counter_items:
+        if name not in typed:
+            lines.append(f'# TYPE {prefix}{name} counter')
+            typed.add(name)
+        lines.append(f'{prefix}{name}{label_text(labels)} {value}')
+    for (name, labels), histogram in histogram_items:
+        if name not in typed:
+            lines.append(f'# TYPE {prefix}{name} histogram')
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(buckets, histogram['buckets']):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{prefix}{name}_bucket{label_text(labels + (("le", le),))} {cumulative}')
+        lines.append(f'{prefix}{name}_sum{label_text(labels)} {histogram["sum"]}')
+        lines.append(f'{prefix}{name}_count{label_text(labels)} {histogram["count"]}')
+
+    # Written to a temporary file first so the collector never reads a partial file
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,148 @@
+"""Disk cache for downloaded web pages. The raw html of every page is stored in the cache directory, keyed by a hash of the
+URL, so reruns after a crash or a parser fix can reuse pages instead of downloading them again. Search result pages change
+as new cases are filed, so they expire much sooner than case pages. The cache is limited in size, when it grows past the
+limit the pages that have gone the longest without being read are removed first. In offline mode pages are served from
+the cache no matter how old they are and nothing is downloaded. Pages are stored and evicted from the crawler's worker
+threads, so the size count and eviction are guarded by a lock."""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+cache_dir = '.page_cache'
+
+# Time in seconds before a cached page is downloaded again
+search_ttl = 24 * 60 * 60
+case_ttl = 7 * 24 * 60 * 60
+
+# Maximum size of the cache directory in bytes
+max_bytes = 500 * 1024 * 1024
+
+# Once the cache is over its limit, pages are removed until it is down to this share of the limit, so the directory is
+# scanned once per batch of removals rather than on every new page
+evict_to = 0.9
+
+# When True pages are only ever read from the cache
+offline = False
+
+# Running total of the cache size, filled in the first time it is needed
+current_bytes = None
+
+# Guards current_bytes and eviction between threads
+lock = threading.Lock()
+
+
+# This function changes the cache settings, any setting left as None keeps its current value
+def configure(directory=None, search_seconds=None, case_seconds=None, size_limit=None, offline_mode=None):
+    global cache_dir, search_ttl, case_ttl, max_bytes, offline, current_bytes
+    if directory is not None:
+        cache_dir = directory
+        current_bytes = None
+    if search_seconds is not None:
+        search_ttl = search_seconds
+    if case_seconds is not None:
+        case_ttl = case_seconds
+    if size_limit is not None:
+        max_bytes = size_limit
+    if offline_mode is not None:
+        offline = offline_mode
+
+
+# Each URL is stored in a file named after the hash of the URL
+def cache_path(url):
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.html')
+
+
+# Search result pages and case pages are given different lifetimes
+def ttl_for(url):
+    if 'caseSearchResults' in url:
+        return search_ttl
+    return case_ttl
+
+
+# This function returns the cached html for a URL, or None if it is missing or expired
+def get(url):
+    path = cache_path(url)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    now = time.time()
+    # The modified time is when the page was downloaded
+    if not offline and now - stat.st_mtime > ttl_for(url):
+        return None
+
+    # The page can be evicted by another thread between the stat and the read
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            html = f.read()
+        # The access time is used to find the least recently used pages when the cache is full
+        os.utime(path, (now, stat.st_mtime))
+    except FileNotFoundError:
+        return None
+    return html
+
+
+# This function stores the html for a URL and removes old pages if the cache is over its size limit
+def put(url, html):
+    global current_bytes
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(url)
+
+    # Write to a temporary file first so a crash never leaves a partial page in the cache, each write gets its own
+    # temporary file so two threads storing the same URL don't write into each other's
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with open(fd, 'w', encoding='utf-8') as f:
+        f.write(html)
+    size = os.path.getsize(tmp_path)
+
+    with lock:
+        if current_bytes is None:
+            current_bytes = cache_size()
+        try:
+            current_bytes -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        current_bytes += size
+
+        if current_bytes > max_bytes:
+            evict()
+
+
+# Total size of the pages currently in the cache
+def cache_size():
+    total = 0
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.html'):
+            total += entry.stat().st_size
+    return total
+
+
+# Remove the least recently used pages until the cache is back under evict_to of its size limit, called with the lock held
+def evict():
+    global current_bytes
+    target = max_bytes * evict_to
+    pages = []
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith('.html'):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        pages.append((stat.st_atime, stat.st_size, entry.path))
+    pages.sort()
+
+    for atime, size, path in pages:
+        if current_bytes <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        current_bytes -= size
@@ -0,0 +1,145 @@
+"""Local index of park names used to search smarter. Every park in the park list is indexed by the character trigrams of
+the distinctive words of its name, along with the plaintiff names seen on its cases in earlier runs, the owners filing
+for the park. When a search has to fall back to a broader query, each hit is checked against the index before its case
+page is downloaded, and hits whose party name belongs to a different park are dropped. A party name that matches no park
+in the index is kept and counted, since it may be an owner not seen yet. Plaintiffs are only learned from cases found by
+the park's exact name or whose party name the index matched to the park, so owners turned up by a loose query never
+become names of the park and the filter keeps working from run to run. The query that found a park's cases in a year is remembered, so a park whose exact name never matches
+starts with the query that worked instead of spending a search on the exact name first. Queries are kept per year
+because the owner filing for a park can change between years. With a checkpoint, plaintiffs and working queries are
+saved and the index improves from run to run."""
+
+import threading
+from collections import defaultdict
+
+import metrics
+import planner
+
+# Words that say what kind of place or business a name belongs to rather than which one, left out when names are compared
+generic_words = {'mobile', 'rv', 'park', 'home', 'homes', 'subdivision', 'resort', 'estate', 'estates', 'community', 'trailer',
+                 'mhp', 'mhc', 'village', 'the', 'of', 'and', 'llc', 'inc', 'lp', 'llp', 'ltd', 'co', 'corp', 'company', 'trust'}
+
+# Lowest trigram similarity, from 0 to 1, at which a party name counts as the park's
+min_similarity = 0.5
+
+
+# The distinctive part of a name, normalized the same way searches are, falling back to every word for names that are all
+# generic words
+def core_name(name):
+    words = planner.query_key(name.split()).split()
+    core = [word for word in words if word not in generic_words]
+    return ' '.join(core or words)
+
+
+# Character trigrams of a name, padded so the start and end of each word count
+def trigrams(name):
+    grams = set()
+    for word in core_name(name).split():
+        padded = f'  {word} '
+        grams.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def similarity(first, second):
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+# Trigram index of every park's known names, shared by the worker threads of a crawl
+class ParkIndex:
+    # With filtering off, every search hit is kept and the index is only used to pick queries and learn plaintiffs
+    def __init__(self, park_names, checkpoint=None, filtering=True):
+        self.checkpoint = checkpoint
+        self.filtering = filtering
+        self.lock = threading.Lock()
+        # Park mapped to the trigrams of each of its known names
+        self.names = defaultdict(dict)
+        # Trigram mapped to the parks with a name containing it
+        self.postings = defaultdict(set)
+        # (park, year) mapped to the query words that found the park's cases that year
+        self.queries = {}
+        # (park, case number) of hits that were kept without being matched to the park, their plaintiffs are not learned
+        self.unmatched = set()
+
+        for park_name in park_names:
+            self.add_name(park_name, park_name)
+        if checkpoint is not None:
+            for park_name, plaintiff in checkpoint.park_plaintiffs():
+                if park_name in self.names:
+                    self.add_name(park_name, plaintiff)
+            self.queries = {key: words for key, words in checkpoint.park_queries().items() if key[0] in self.names}
+
+    def add_name(self, park_name, name):
+        key = core_name(name)
+        if not key or key in self.names[park_name]:
+            return False
+        grams = trigrams(name)
+        self.names[park_name][key] = grams
+        for gram in grams:
+            self.postings[gram].add(park_name)
+        return True
+
+    # Similarity of a name to each park that shares a trigram with it, only parks sharing a trigram are scored
+    def scores(self, name):
+        grams = trigrams(name)
+        with self.lock:
+            candidates = set()
+            for gram in grams:
+                candidates.update(self.postings.get(gram, ()))
+            return {park_name: max(similarity(grams, known) for known in self.names[park_name].values()) for park_name in candidates}
+
+    # The query words that found the park's cases in the year before, or None if none were saved for that year
+    def best_query(self, park_name, year):
+        with self.lock:
+            return self.queries.get((park_name, year))
+
+    # This function keeps the search hits, as (case_number, party) pairs, whose party name matches the park at least as
+    # well as any other park. Hits without a party name are kept since they can't be checked, and so are hits whose
+    # party name matches no park well enough, counted as search_hits_unmatched. With filtering off every hit is kept.
+    # Kept hits that weren't matched to the park are remembered so their plaintiffs are not learned.
+    def filter_hits(self, park_name, hits):
+        kept = []
+        unmatched = []
+        for case_number, party in hits:
+            matched = False
+            if party is not None:
+                scores = self.scores(party)
+                best = max(scores.values(), default=0.0)
+                if best < min_similarity:
+                    metrics.increment('search_hits_unmatched')
+                elif scores.get(park_name, 0.0) >= best:
+                    matched = True
+                elif self.filtering:
+                    continue
+            kept.append((case_number, party))
+            if not matched:
+                unmatched.append((park_name, case_number))
+        with self.lock:
+            self.unmatched.update(unmatched)
+        if len(kept) < len(hits):
+            metrics.increment('search_hits_filtered', len(hits) - len(kept))
+        return kept
+
+    # Remembers the query that found a park's cases in a year
+    def learn_query(self, park_name, year, words):
+        with self.lock:
+            if self.queries.get((park_name, year)) == words:
+                return
+            self.queries[(park_name, year)] = words
+        if self.checkpoint is not None:
+            self.checkpoint.set_park_query(park_name, year, words)
+
+    # Adds a plaintiff seen on one of the park's cases to the park's known names, unless the case came from a search hit
+    # that was kept without being matched to the park
+    def learn_plaintiff(self, park_name, plaintiff, case_number=None):
+        if park_name is None or not plaintiff:
+            return
+        with self.lock:
+            if (park_name, case_number) in self.unmatched:
+                return
+            added = self.add_name(park_name, plaintiff)
+        if added:
+            metrics.increment('plaintiffs_learned')
+            if self.checkpoint is not None:
+                self.checkpoint.add_park_plaintiff(park_name, plaintiff)
@@ -3,26 +3,54 @@ are used to generate additional URLs to the webpage for a specific court case. T
 pull certain data from those webpages. Each of these webpages are structured the same way, allowing this data to be pulled
 in a uniform manner. The method for this is a keyword search and additional parsing to filter out excpetions and deliver
 clean data to the google sheet. The logic for parsing the data was developed by reading the structure of the converted
-text file and determining commonalities that existed among all case URLs."""
+text file and determining commonalities that existed among all case URLs. Case pages are first read through the
+structured extraction in extract, the keyword search is used for any field it can't find."""
 
 
-import requests
-from bs4 import BeautifulSoup
 import re
 import warnings
+from collections import namedtuple
+
+import extract
+import http_client
+import metrics
+import page_cache
 
 warnings.filterwarnings("ignore")
 
+# All of the data pulled from a single case page, built by parse_case so each page is only downloaded and parsed once
+CaseRecord = namedtuple('CaseRecord', ['url', 'plaintiff', 'defendants', 'judgments', 'judgment_date', 'total_amount', 'rent',
+                                       'attorney_fees', 'tax', 'utilities', 'late_charge', 'notice_fees', 'costs', 'undesignated',
+                                       'file_date'])
+
+# This function downloads the raw html of a web page, pages that were already downloaded are read from the disk cache
+def get_html(url):
+    html = page_cache.get(url)
+    if html is not None:
+        metrics.increment('cache_hits')
+        return html
+    metrics.increment('cache_misses')
+    if page_cache.offline:
+        print(f"Page not in cache, skipped in offline mode: {url}")
+        return None
+
+    with metrics.timer('download_seconds'):
+        html = http_client.fetch(url)
+    if html is not None:
+        page_cache.put(url, html)
+    return html
+
+# This function converts the html of a web page to a text file, with each piece of text on its own line
+def html_to_text(html):
+    return '\n'.join(extract.text_cells(html))
+
 # This function is used to convert the web page to a text file
 def get_text(url):
-    response = requests.get(url, verify=False)
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        all_text = soup.get_text()
-        return all_text
+    with metrics.timer('get_html_seconds'):
+        html = get_html(url)
+    if html is not None:
+        return html_to_text(html)
     else:
-        print(f"Failed to retrieve webpage. Status code: {response.status_code}")
         return None
 
 # Each case number is preceded by the text "CC", this is used to compile a list of case numbers that are then used to generate the URL needed for obtaining case data
@@ -43,13 +71,18 @@ def get_case_numbers(url):
 
     return case_numbers
 
+# The case numbers of a search results page along with the party name listed next to each, as (case_number, party) pairs
+def get_search_hits(url):
+    with metrics.timer('get_html_seconds'):
+        html = get_html(url)
+    if html is None:
+        return None
+    return extract.search_hits(extract.text_cells(html))
+
 # Data on defendant name is obtained through a keyword search and further parsing based on web page structure
-def get_defendants(url):
-    file_content = get_text(url)
+def parse_defendants(words):
     search_word = 'Defendant'
 
-    words = file_content.split()
-
     defendants = []
 
     for index, word in enumerate(words):
@@ -99,10 +132,7 @@ def get_defendants(url):
 
 
 # This function pulls the plaintiff for each case
-def get_plaintiff(url):
-    file_content = get_text(url)
-
-    words = file_content.split()
+def parse_plaintiff(words):
     plaintiff = []
     search_word = 'Plaintiff'
     # Iterates through the text file for the search word then parses the data based on the structure of the web page
@@ -118,11 +148,7 @@ def get_plaintiff(url):
     return plaintiff
 
 # This function finds whether or not the judgment was satisfied by searching the text file for a specific pattern
-def get_judgments(url):
-    file_content = get_text(url)
-
-    words = file_content.split()
-    plaintiff = []
+def parse_judgments(words, file_content):
     search_word = 'Judgments'
     for index, word in enumerate(words):
         
@@ -140,127 +166,78 @@ def get_judgments(url):
 
                 return judgments, judgment_date
             
-# This function finds the charges the defendants owe to the plaintiff, what each charge is, how much each charge is, and what the total amount owed is
-def get_amounts(url):
-    file_content = get_text(url)
+# This function builds a CaseRecord from the html of a case page. The page is parsed once into text cells and the fields
+# are pulled from the page structure, any field the structure doesn't turn up falls back to the keyword search on the words
+def parse_case_html(html, url=None):
+    with metrics.timer('parse_seconds', step='tokenize'):
+        cells = extract.text_cells(html)
+    with metrics.timer('parse_seconds', step='structured'):
+        fields = extract.extract_fields(cells)
+    file_content = '\n'.join(cells)
     words = file_content.split()
-    search_word = '$'
-    rent = []
-    attorney_fees = []
-    tax = []
-    late_charge = []
-    notice_fees = []
-    costs = []
-    undesignated = []
-    utilities = []
-    total_judgment = []
-    for index, word in enumerate(words):
-        
-        if search_word in word:
-            if words[index + 1:index + 2] == ['Total']:
-                if ',' in word:
-                    total_judgment.append(float(word.replace('$', '').replace(',', '')))
-                    break
-                else:
-                    total_judgment.append(float(word.replace('$', '')))
-                    break
-            if words[index + 1:index + 2] == ['Attorney']:
-                if ',' in word:
-                    attorney_fees.append(float(word.replace('$', '').replace(',', '')))
-                else:
-                    attorney_fees.append(float(word.replace('$', '')))
-            if words[index + 1:index + 2] == ['Costs']:
-                if ',' in word:
-                    costs.append(float(word.replace('$', '').replace(',', '')))
-                else:
-                    costs.append(float(word.replace('$', '')))
-            if words[index + 1:index + 2] == ['Utilities']:
-                if ',' in word:
-                    utilities.append(float(word.replace('$', '').replace(',', '')))
-                else:
-                    utilities.append(float(word.replace('$', '')))
-            if words[index + 1:index + 2] == ['Undesignated']:
-                if ',' in word:
-                    undesignated.append(float(word.replace('$', '').replace(',', '')))
-                else:
-                    undesignated.append(float(word.replace('$', '')))
-            if words[index + 1:index + 2] == ['Tax']:
-                if ',' in word:
-                    tax.append(float(word.replace('$', '').replace(',', '')))
-                else:
-                    tax.append(float(word.replace('$', '')))
-            if words[index + 1:index + 2] == ['Notice']:
-                if ',' in word:
-                    notice_fees.append(float(word.replace('$', '').replace(',', '')))
-                else:
-                    notice_fees.append(float(word.replace('$', '')))
-            if words[index + 1:index + 2] == ['Late']:
-                if ',' in word:
-                    late_charge.append(float(word.replace('$', '').replace(',', '')))
-                else:
-                    late_charge.append(float(word.replace('$', '')))
-            if words[index + 1:index + 2] == ['Rent']:
-                if ',' in word:
-                    rent.append(float(word.replace('$', '').replace(',', '')))
-                elif '(' in word and ')' in word:
-                    late_charge.append(float(word.replace('$', '').replace('(', '').replace(')', '')))
-                else:
-                    late_charge.append(float(word.replace('$', '')))
-
-    if len(total_judgment) == 0:
-        total_judgment = 0
-    else:
-        total_judgment = sum(total_judgment)
-    if len(attorney_fees) == 0:
-        attorney_fees = 0
-    else:
-        attorney_fees = sum(attorney_fees)
-    if len(costs) == 0:
-        costs = 0
-    else:
-        costs = sum(costs)
-    if len(utilities) == 0:
-        utilities = 0
-    else:
-        utilities = sum(utilities)
-    if len(undesignated) == 0:
-        undesignated = 0
-    else:
-        undesignated = sum(undesignated)
-    if len(tax) == 0:
-        tax = 0
-    else:
-        tax = sum(tax)
-    if len(notice_fees) == 0:
-        notice_fees = 0
-    else:
-        notice_fees = sum(notice_fees)
-    if len(late_charge) == 0:
-        late_charge = 0
+
+    # Each field that needed the keyword search is counted, a rise here means the page layout has changed
+    plaintiff = fields['plaintiff']
+    if plaintiff is None:
+        metrics.increment('parse_fallbacks', field='plaintiff')
+        with metrics.timer('parse_seconds', step='plaintiff_fallback'):
+            plaintiff = parse_plaintiff(words)
+    defendants = fields['defendants']
+    if defendants is None:
+        metrics.increment('parse_fallbacks', field='defendants')
+        with metrics.timer('parse_seconds', step='defendants_fallback'):
+            defendants = parse_defendants(words)
+    judgments = fields['judgments']
+    if judgments is None:
+        metrics.increment('parse_fallbacks', field='judgments')
+        with metrics.timer('parse_seconds', step='judgments_fallback'):
+            judgments = parse_judgments(words, file_content)
+    if judgments is not None:
+        judgments, judgment_date = judgments
     else:
-        late_charge = sum(late_charge)
-    if len(rent) == 0:
-        rent = 0
+        judgment_date = None
+    total_amount, rent, attorney_fees, tax, utilities, late_charge, notice_fees, costs, undesignated = fields['amounts']
+
+    return CaseRecord(url, plaintiff, defendants, judgments, judgment_date, total_amount, rent, attorney_fees, tax, utilities,
+                      late_charge, notice_fees, costs, undesignated, fields['file_date'])
+
+# This function downloads a case page a single time and pulls all of the data from it
+def parse_case(url):
+    html = get_html(url)
+    if html is not None:
+        return parse_case_html(html, url)
     else:
-        rent = sum(rent)
+        return None
 
-    
+# The functions below pull a single field from a case page, they are kept for anything that only needs one value
+def get_defendants(url):
+    return parse_case(url).defendants
 
-    total_amount = (total_judgment) + (attorney_fees) + (costs) + (utilities) + (undesignated) + (tax) + (notice_fees) + (late_charge) + (rent)
+def get_plaintiff(url):
+    return parse_case(url).plaintiff
 
-    return total_amount, rent, attorney_fees, tax, utilities, late_charge, notice_fees, costs, undesignated
+def get_judgments(url):
+    record = parse_case(url)
+    if record.judgments is None:
+        return None
+    return record.judgments, record.judgment_date
+
+def get_amounts(url):
+    record = parse_case(url)
+    return record.total_amount, record.rent, record.attorney_fees, record.tax, record.utilities, record.late_charge, record.notice_fees, record.costs, record.undesignated
 
 if __name__ == '__main__':
     # This will run a test to see if the data is being pulled correctly based off a provided URL
 
 
     url = 'https://justicecourts.maricopa.gov/app/courtrecords/CaseInfo?casenumber=CC2023017083000'
-    text = get_text(url)
-    case_number = get_case_numbers(url)  
-    defendants = get_defendants(url)
-    plaintiff = get_plaintiff(url) 
-    judgments, judgment_date = get_judgments(url)
-    total_amount, rent, attorney_fees, tax, utilities, late_charge, notice_fees, costs, undesignated = get_amounts(url) 
+    case_number = get_case_numbers(url)
+    record = parse_case(url)
+    defendants = record.defendants
+    plaintiff = record.plaintiff
+    judgments, judgment_date = record.judgments, record.judgment_date
+    total_amount, rent, attorney_fees, tax, utilities = record.total_amount, record.rent, record.attorney_fees, record.tax, record.utilities
+    late_charge, notice_fees, costs, undesignated = record.late_charge, record.notice_fees, record.costs, record.undesignated
     print('Case Number:', case_number)
     print('Defendants', defendants)  
     print('Plaintiff:', plaintiff)
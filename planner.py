@@ -0,0 +1,75 @@
+"""Planning for the searches made during a run. Park names are normalized before crawling so parks that would send the
+same search are only searched once. While the crawl runs, every search result is remembered by its normalized query
+and year, so when the broader search for one park turns out to be the same as another park's search, the result is
+reused instead of being downloaded again. Threads asking for a search that is already in flight wait for it rather
+than sending their own."""
+
+import threading
+from concurrent.futures import Future
+
+import metrics
+
+# Punctuation trimmed from the ends of each word of a park name
+trimmed_punctuation = '.,;:"\''
+
+
+# The normalized form of a search, lowercase words with surrounding punctuation removed
+def query_key(words):
+    key_words = []
+    for word in words:
+        word = word.lower().strip(trimmed_punctuation)
+        if word:
+            key_words.append(word)
+    return ' '.join(key_words)
+
+
+# This function removes parks whose names normalize to the same search, keeping the first one in the list
+def dedupe_parks(park_names):
+    unique_parks = []
+    seen = set()
+    for park_name in park_names:
+        key = query_key(park_name.split())
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        unique_parks.append(park_name)
+
+    skipped = len(park_names) - len(unique_parks)
+    if skipped:
+        metrics.increment('duplicate_parks_skipped', skipped)
+        print(f'Skipping {skipped} parks that repeat another park\'s search')
+    return unique_parks
+
+
+# Remembers search results for the length of a run, shared by every worker thread
+class SearchCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+
+    # Returns the result for the query, running search() only if no other thread has run or is running it.
+    # Failed searches, which return None, are forgotten so they can be tried again.
+    def get(self, words, year, search):
+        key = (query_key(words), year)
+        with self.lock:
+            future = self.results.get(key)
+            owner = future is None
+            if owner:
+                future = self.results[key] = Future()
+
+        if not owner:
+            metrics.increment('duplicate_searches_skipped')
+            return future.result()
+
+        try:
+            result = search()
+        except Exception as e:
+            with self.lock:
+                del self.results[key]
+            future.set_exception(e)
+            raise
+        if result is None:
+            with self.lock:
+                del self.results[key]
+        future.set_result(result)
+        return result
@@ -0,0 +1,150 @@
+"""Post-processing of each batch of rows before it is sent, so reruns don't pile duplicate leads into the sheet. The rows
+already in the sheet are read once at the start of a run and kept in a hash index by case number, along with each
+lead's normalized defendant name and running totals. Each batch is then handled as a whole with pandas: duplicates
+inside the batch are dropped, the batch is compared with the index in a single vectorized step, and only leads that are
+new or whose data changed are sent. Looking up a batch only touches the cases in that batch, so the cost of each batch
+grows with the batch and not with the sheet. The index also keeps the total owed by each defendant across their cases
+and by each plaintiff, the park owner filing the cases, which can be saved at the end of a run."""
+
+import pandas as pd
+
+import metrics
+import sinks
+
+# The case number is the text shown by the hyperlink formula in the second column
+hyperlink_pattern = r'HYPERLINK\(.*,\s*"([^"]+)"\)'
+case_number_pattern = r'^(CC\w+)$'
+
+# Columns compared to decide whether a lead changed, the hyperlink is left out since it is built from the case number
+text_columns = ['plaintiff', 'defendants', 'judgments', 'judgment_date']
+
+
+# Names in uppercase with punctuation and extra spaces removed, so "Smith, John " and "SMITH JOHN" match
+def normalize_names(names):
+    return names.fillna('').astype(str).str.upper().str.replace(r'[^\w\s]', ' ', regex=True).str.split().str.join(' ')
+
+
+# Dollar amounts as numbers, whether they come from the crawler or are read back from the sheet as text like "$1,250.00"
+def to_amounts(values):
+    numbers = pd.to_numeric(values.astype(str).str.replace(r'[$,\s]', '', regex=True), errors='coerce')
+    return numbers.fillna(0).round(2)
+
+
+# The form of each row used for comparisons, text stripped, defendant names normalized and amounts as numbers
+def comparable(frame):
+    compared = pd.DataFrame(index=frame.index)
+    for column in text_columns:
+        compared[column] = frame[column].fillna('').astype(str).str.strip()
+    compared['defendants'] = normalize_names(frame['defendants'])
+    for column in sinks.amount_columns:
+        compared[column] = to_amounts(frame[column])
+    return compared
+
+
+# Index of the leads already sent, built once at the start of a run and kept up to date as batches are sent
+class LeadIndex:
+    def __init__(self, frame, row_numbers=None, next_row=None):
+        compared = comparable(frame)
+        self.compared_columns = list(compared.columns)
+        # Case number mapped to its row in compared form
+        self.leads = dict(zip(compared.index, compared.itertuples(index=False, name=None)))
+        # Sheet row of each case, shared with the sheet sink so rows of known cases are overwritten in place
+        self.row_numbers = row_numbers if row_numbers is not None else {}
+        self.next_row = next_row
+        # Normalized name mapped to [number of cases, total amount]
+        self.defendant_totals = {}
+        self.plaintiff_totals = {}
+        self.add_totals(compared, 1)
+
+    # Builds the index from every row of the worksheet with a single read. Formulas are read as written so the case
+    # number can be taken from the hyperlink, and dates are read as they are shown.
+    @classmethod
+    def from_sheet(cls, worksheet):
+        with metrics.timer('sheet_read_seconds'):
+            values = worksheet.get_values(value_render_option='FORMULA', date_time_render_option='FORMATTED_STRING')
+        width = len(sinks.columns)
+        frame = pd.DataFrame([(row + [''] * width)[:width] for row in values], columns=sinks.columns)
+        frame['row_number'] = range(1, len(frame) + 1)
+
+        # The sheet is filled from the top, so the next row is the first one with an empty first column
+        empty = frame.index[frame['plaintiff'].astype(str) == '']
+        next_row = int(empty[0]) + 1 if len(empty) else len(frame) + 1
+
+        links = frame['hyperlink_formula'].astype(str)
+        case_numbers = links.str.extract(hyperlink_pattern)[0].fillna(links.str.extract(case_number_pattern)[0])
+        frame = frame[case_numbers.notna()].set_index(case_numbers[case_numbers.notna()].rename('case_number'))
+        # Rows sent twice by earlier runs are counted, the first one is the one that gets updated
+        duplicated = frame.index.duplicated(keep='first')
+        if duplicated.any():
+            metrics.increment('sheet_duplicate_rows', int(duplicated.sum()))
+            print(f'The sheet already has {int(duplicated.sum())} duplicate rows')
+        frame = frame[~duplicated]
+        return cls(frame, row_numbers=dict(zip(frame.index, frame['row_number'])), next_row=next_row)
+
+    # Builds the index from (case_number, row) pairs, like the rows read back from a local sink
+    @classmethod
+    def from_rows(cls, rows):
+        rows = list(rows)
+        frame = pd.DataFrame([row for case_number, row in rows], columns=sinks.columns,
+                             index=pd.Index([case_number for case_number, row in rows], name='case_number'))
+        return cls(frame[~frame.index.duplicated(keep='last')])
+
+    # Adds (sign 1) or removes (sign -1) the rows of a compared frame from the defendant and plaintiff totals
+    def add_totals(self, compared, sign):
+        if len(compared) == 0:
+            return
+        for names, totals in ((compared['defendants'], self.defendant_totals), (normalize_names(compared['plaintiff']), self.plaintiff_totals)):
+            grouped = compared['total_amount'].groupby(names.values).agg(['count', 'sum'])
+            for name, cases, amount in grouped.itertuples():
+                if not name:
+                    continue
+                entry = totals.setdefault(name, [0, 0.0])
+                entry[0] += sign * int(cases)
+                entry[1] += sign * float(amount)
+
+    # This function takes a RowBuffer and returns a RowBuffer of the leads in it that are new or changed, the case numbers
+    # of the changed ones, and the selection to pass to commit once the rows have been sent. Leads that match the index
+    # exactly are dropped. The index itself is left as it is, so a batch that fails to send is picked the same way when
+    # it is tried again.
+    def fresh_rows(self, buffer):
+        frame = pd.DataFrame(buffer.data, columns=sinks.columns, index=pd.Index(buffer.case_numbers, name='case_number'))
+        frame = frame[~frame.index.duplicated(keep='last')]
+        compared = comparable(frame)
+
+        # Only the cases in this batch are looked up in the index
+        known = [case_number in self.leads for case_number in compared.index]
+        known_cases = compared.index[known]
+        previous = pd.DataFrame([self.leads[case_number] for case_number in known_cases], columns=self.compared_columns,
+                                index=known_cases)
+        changed = (compared.loc[known_cases] != previous).any(axis=1)
+        changed_cases = set(known_cases[changed.values])
+        keep = [not is_known or case_number in changed_cases for case_number, is_known in zip(compared.index, known)]
+        selection = (compared[keep], previous[changed.values], len(buffer) - sum(keep))
+
+        fresh = sinks.RowBuffer()
+        kept = frame[keep]
+        for column in sinks.columns:
+            fresh.data[column] = [None if pd.isna(value) else value for value in kept[column].tolist()]
+        fresh.case_numbers = list(kept.index)
+        return fresh, changed_cases, selection
+
+    # Adds the leads picked by fresh_rows to the index and the totals, called once they have been sent
+    def commit(self, selection):
+        kept, replaced, skipped = selection
+        metrics.increment('leads_new', len(kept) - len(replaced))
+        metrics.increment('leads_changed', len(replaced))
+        metrics.increment('duplicate_leads_skipped', skipped)
+
+        self.add_totals(replaced, -1)
+        self.add_totals(kept, 1)
+        self.leads.update(zip(kept.index, kept.itertuples(index=False, name=None)))
+
+    # The defendant and plaintiff totals as one table, largest amounts first
+    def totals(self):
+        records = [('defendant', name, cases, round(amount, 2)) for name, (cases, amount) in self.defendant_totals.items() if cases > 0]
+        records += [('plaintiff', name, cases, round(amount, 2)) for name, (cases, amount) in self.plaintiff_totals.items() if cases > 0]
+        frame = pd.DataFrame(records, columns=['kind', 'name', 'cases', 'total_amount'])
+        return frame.sort_values(['kind', 'total_amount'], ascending=[True, False], ignore_index=True)
+
+    def write_totals(self, path):
+        self.totals().to_csv(path, index=False)
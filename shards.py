@@ -0,0 +1,169 @@
+"""Splitting a crawl across several workers. The park list is divided into shards by a hash of each park's normalized
+name, so a park always lands in the same shard no matter the order of the list or which worker reads it. Each shard is
+crawled as an independent run with its own output file and checkpoint. Workers coordinate through a small SQLite
+ledger in a shared directory: each worker claims the next open shard, crawls it and marks it finished, then claims
+another, so adding workers or machines adds throughput. While a shard is crawled its worker renews the lease from a
+background thread, so a shard claimed by a worker that stopped without finishing it is handed out again soon after
+the renewals stop, and resumes from its checkpoint. Once every shard is finished the merge
+step reads every shard's output, drops cases found by more than one shard and produces the final rows."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+import planner
+import sinks
+
+default_ledger = 'shards.db'
+
+# Seconds a claimed shard can go without its lease being renewed before another worker may take it over
+lease_seconds = 30 * 60
+
+# Seconds between lease renewals while a shard is being crawled
+renew_seconds = 5 * 60
+
+
+# The shard a park belongs to, worked out from its normalized name so spelling differences in case or punctuation
+# don't move it
+def shard_of(park_name, shard_count):
+    key = planner.query_key(park_name.split())
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % shard_count
+
+
+# The parks of the list that belong to one shard, in their original order
+def shard_parks(park_names, shard, shard_count):
+    return [park_name for park_name in park_names if shard_of(park_name, shard_count) == shard]
+
+
+# The file used by one shard in place of path, leads.csv becomes leads.shard-2-of-8.csv
+def shard_path(path, shard, shard_count):
+    root, extension = os.path.splitext(path)
+    return f'{root}.shard-{shard}-of-{shard_count}{extension}'
+
+
+# Shared record of which shards are open, claimed by a worker, or finished
+class Ledger:
+    def __init__(self, path=default_ledger, shard_count=None):
+        self.path = path
+        # Transactions are started by hand so a claim can lock the ledger before reading it
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS shards (
+                shard INTEGER PRIMARY KEY,
+                shard_count INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                claimed_at REAL,
+                finished_at REAL
+            )
+        ''')
+        if shard_count is not None:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                counts = {row[0] for row in self.conn.execute('SELECT DISTINCT shard_count FROM shards')}
+                if counts and counts != {shard_count}:
+                    raise ValueError(f'{path} was created for {counts.pop()} shards, not {shard_count}')
+                self.conn.executemany("INSERT OR IGNORE INTO shards (shard, shard_count, status) VALUES (?, ?, 'open')",
+                                      [(shard, shard_count) for shard in range(shard_count)])
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    # Takes the next open shard for a worker, returned as (shard, reclaimed) where reclaimed is True when the shard was
+    # taken over from a worker whose lease ran out. Returns None once every shard is claimed or finished.
+    def claim(self, worker):
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute('''
+                SELECT shard, status FROM shards
+                WHERE status = 'open' OR (status = 'claimed' AND claimed_at < ?)
+                ORDER BY status = 'claimed', shard LIMIT 1
+            ''', (now - lease_seconds,)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE shards SET status = 'claimed', worker = ?, claimed_at = ? WHERE shard = ?", (worker, now, row[0]))
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        if row is None:
+            return None
+        return row[0], row[1] == 'claimed'
+
+    # Pushes back the end of a worker's lease on a shard, returns False when the shard is no longer claimed by the worker
+    def renew(self, shard, worker):
+        cursor = self.conn.execute("UPDATE shards SET claimed_at = ? WHERE shard = ? AND worker = ? AND status = 'claimed'",
+                                   (time.time(), shard, worker))
+        return cursor.rowcount == 1
+
+    # Marks a shard finished, returns False without changing it when another worker has taken the shard over
+    def finish(self, shard, worker):
+        cursor = self.conn.execute('''
+            UPDATE shards SET status = 'finished', finished_at = ?
+            WHERE shard = ? AND worker = ? AND status = 'claimed'
+        ''', (time.time(), shard, worker))
+        return cursor.rowcount == 1
+
+    # Puts a shard back so another worker can take it, used when a worker fails partway through. A shard another worker
+    # has taken over is left alone.
+    def release(self, shard, worker):
+        self.conn.execute('''
+            UPDATE shards SET status = 'open', worker = NULL, claimed_at = NULL
+            WHERE shard = ? AND worker = ? AND status = 'claimed'
+        ''', (shard, worker))
+
+    # Shards that are not finished yet, as (shard, status, worker)
+    def unfinished(self):
+        return self.conn.execute("SELECT shard, status, worker FROM shards WHERE status != 'finished' ORDER BY shard").fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+# Renews a worker's lease on a shard every renew_seconds while the block runs. The renewals run in a thread with its own
+# connection to the ledger, and stop early if the shard has been taken over by another worker.
+@contextmanager
+def lease_kept(path, shard, worker):
+    stopped = threading.Event()
+
+    def renew():
+        ledger = Ledger(path)
+        try:
+            while not stopped.wait(renew_seconds):
+                if not ledger.renew(shard, worker):
+                    print(f'Lost the lease on shard {shard}, another worker has taken it over')
+                    metrics.increment('shard_leases_lost')
+                    break
+        finally:
+            ledger.close()
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+# This function reads the output of every shard and returns the combined (case_number, row) pairs. A case found by more
+# than one shard, when parks in different shards return the same case, is only kept once. Shards without output yet
+# are skipped.
+def merge_rows(kind, path, shard_count):
+    merged = {}
+    for shard in range(shard_count):
+        path_for_shard = shard_path(path, shard, shard_count)
+        if not os.path.exists(path_for_shard):
+            print(f'No output for shard {shard}: {path_for_shard}')
+            continue
+        for case_number, row in sinks.read_rows(kind, path_for_shard):
+            if case_number in merged:
+                metrics.increment('merge_duplicates')
+                continue
+            merged[case_number] = row
+    return list(merged.items())
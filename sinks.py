@@ -0,0 +1,305 @@
+"""Export sinks that the rows pulled from each case are sent to. Rows are held in a columnar buffer, one list per column,
+and sent in batches. A batch is sent once the buffer holds enough rows, grows past a size limit, or has been waiting
+long enough. The google sheet sink sends each batch with a single append_rows call, and it remembers the next empty
+row itself so the sheet only has to be read once, no matter how large it grows. Rows can also be streamed to local CSV,
+Parquet or SQLite files, which don't need a google account and aren't limited by the sheets api, and sent to the sheet
+later. Rows for cases that were already sent can be replaced, the sheet sink overwrites the case's existing row and the
+local sinks keep the latest row written for each case. A sink can be given a LeadIndex of the rows already sent, from
+postprocess, in which case each batch is checked against it and only new or changed leads are written."""
+
+import csv
+import os
+import sqlite3
+import sys
+import time
+
+import metrics
+
+# Columns of the data sent to the google sheet
+columns = ['plaintiff', 'hyperlink_formula', 'defendants', 'judgments', 'judgment_date', 'total_amount', 'rent', 'attorney_fees', 'tax', 'utilities', 'late_charge', 'notice_fees', 'costs', 'undesignated']
+
+# Columns that hold dollar amounts
+amount_columns = ['total_amount', 'rent', 'attorney_fees', 'tax', 'utilities', 'late_charge', 'notice_fees', 'costs', 'undesignated']
+
+
+# Holds rows as one list per column, along with the case number of each row
+class RowBuffer:
+    def __init__(self, columns=columns):
+        self.columns = columns
+        self.data = {column: [] for column in columns}
+        self.case_numbers = []
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.case_numbers)
+
+    def append(self, case_number, row):
+        for column in self.columns:
+            value = row.get(column)
+            self.data[column].append(value)
+            self.nbytes += sys.getsizeof(value)
+        self.case_numbers.append(case_number)
+
+    # The buffered data as a list of rows, with empty cells for missing values
+    def rows(self):
+        return [['' if value is None else value for value in row] for row in zip(*(self.data[column] for column in self.columns))]
+
+    def clear(self):
+        for values in self.data.values():
+            values.clear()
+        self.case_numbers.clear()
+        self.nbytes = 0
+
+
+# This function is used when sending data to the google sheet, making sure it is sent to the next empty row
+def find_next_empty_row(sheet):
+    col_values = sheet.col_values(1)
+
+    next_empty_row = col_values.index('') + 1 if '' in col_values else len(col_values) + 1
+
+    return next_empty_row
+
+
+# Base class for the sinks, it handles buffering and deciding when a batch is sent
+class Sink:
+    def __init__(self, flush_rows=20, flush_bytes=1024 * 1024, flush_seconds=300, on_flush=None, leads=None):
+        self.buffer = RowBuffer()
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        # Called with the case numbers of each batch once it has been sent
+        self.on_flush = on_flush
+        # Index of the leads already sent, batches are checked against it before they are written
+        self.leads = leads
+        # Cases whose new row replaces the one already sent
+        self.replacing = set()
+        self.first_buffered = None
+
+    def add(self, case_number, row):
+        if self.first_buffered is None:
+            self.first_buffered = time.monotonic()
+        self.buffer.append(case_number, row)
+        self.flush_if_due()
+
+    # Sends the buffer if it is due, called regularly by the crawler so a batch that has waited flush_seconds is sent even
+    # when no new rows arrive
+    def flush_if_due(self):
+        if self.should_flush():
+            self.flush()
+
+    def should_flush(self):
+        if len(self.buffer) == 0:
+            return False
+        return (len(self.buffer) >= self.flush_rows or self.buffer.nbytes >= self.flush_bytes
+                or time.monotonic() - self.first_buffered >= self.flush_seconds)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        batch = self.buffer
+        selection = None
+        if self.leads is not None:
+            with metrics.timer('postprocess_seconds'):
+                batch, changed, selection = self.leads.fresh_rows(self.buffer)
+            self.replacing.update(changed)
+        if len(batch):
+            with metrics.timer('flush_seconds', sink=type(self).__name__):
+                self.write(batch)
+            metrics.increment('rows_exported', len(batch), sink=type(self).__name__)
+        # The index only learns the batch once it has been written, if the write raised the buffer is kept and the whole
+        # batch is sent again by the next flush
+        if selection is not None:
+            self.leads.commit(selection)
+        # Every case of the batch counts as sent, including duplicates that were already in the output
+        if self.on_flush is not None:
+            self.on_flush(list(self.buffer.case_numbers))
+        self.buffer.clear()
+        self.replacing.clear()
+        self.first_buffered = None
+        print()
+        print('Data Sent')
+        print()
+
+    # Sends a new row for a case that was sent before. The local sinks treat a later row for the same case as replacing
+    # the earlier one, the sheet sink overwrites the case's row.
+    def replace(self, case_number, row):
+        self.replacing.add(case_number)
+        self.add(case_number, row)
+
+    # Subclasses send the buffered rows to their destination
+    def write(self, buffer):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+# Sends rows to a worksheet of the google sheet
+class SheetSink(Sink):
+    def __init__(self, worksheet, **kwargs):
+        super().__init__(**kwargs)
+        self.worksheet = worksheet
+        # Found once when the first batch is sent and then kept up to date locally
+        self.next_row = None
+        # Sheet row number of each case, only read from the sheet when a row has to be replaced
+        self.case_rows = None
+
+    # The hyperlink in the second column shows the case number, so it is used to find the row of each case
+    def find_case_rows(self):
+        return {value: index + 1 for index, value in enumerate(self.worksheet.col_values(2)) if value}
+
+    def write(self, buffer):
+        # The lead index already read the whole sheet, so it knows the next empty row and the row of every case
+        if self.next_row is None:
+            self.next_row = self.leads.next_row if self.leads is not None else find_next_empty_row(self.worksheet)
+        if self.case_rows is None and self.leads is not None:
+            self.case_rows = self.leads.row_numbers
+        if self.replacing and self.case_rows is None:
+            self.case_rows = self.find_case_rows()
+
+        new_rows = []
+        new_case_numbers = []
+        updates = []
+        for case_number, row in zip(buffer.case_numbers, buffer.rows()):
+            row_number = self.case_rows.get(case_number) if case_number in self.replacing else None
+            if row_number is None:
+                new_rows.append(row)
+                new_case_numbers.append(case_number)
+            else:
+                updates.append({'range': f'A{row_number}', 'values': [row]})
+
+        # Formulas like the case hyperlink are only kept when the values are entered as if typed by a user
+        if updates:
+            self.worksheet.batch_update(updates, value_input_option='USER_ENTERED')
+        if new_rows:
+            self.worksheet.append_rows(new_rows, value_input_option='USER_ENTERED', insert_data_option='OVERWRITE',
+                                       table_range=f'A{self.next_row}')
+            if self.case_rows is not None:
+                for offset, case_number in enumerate(new_case_numbers):
+                    self.case_rows[case_number] = self.next_row + offset
+            self.next_row += len(new_rows)
+
+
+# Columns written by the local sinks, the case number is kept so files can be merged and sent to the sheet later
+local_columns = ['case_number'] + columns
+
+
+# Appends rows to a CSV file, the header is written when the file is first created
+class CsvSink(Sink):
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def write(self, buffer):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(local_columns)
+            for case_number, row in zip(buffer.case_numbers, buffer.rows()):
+                writer.writerow([case_number] + row)
+
+
+# Writes rows to Parquet files in a directory, each run adds a new file and each batch is written as its own row group.
+# pyarrow is only needed when this sink is used.
+class ParquetSink(Sink):
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.writer = None
+
+    def write(self, buffer):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        data = {'case_number': pa.array(buffer.case_numbers, pa.string())}
+        for column in columns:
+            values = buffer.data[column]
+            # Amount columns are numbers, everything else is stored as text
+            if column in amount_columns:
+                data[column] = pa.array(values, pa.float64())
+            else:
+                data[column] = pa.array([None if value is None else str(value) for value in values], pa.string())
+        table = pa.table(data)
+
+        if self.writer is None:
+            os.makedirs(self.path, exist_ok=True)
+            file_name = os.path.join(self.path, f'part-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.parquet')
+            self.writer = pq.ParquetWriter(file_name, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+# Writes rows to a table in a SQLite file, a case that is written again replaces its earlier row
+class SqliteSink(Sink):
+    def __init__(self, path, table='leads', **kwargs):
+        super().__init__(**kwargs)
+        self.table = table
+        # Batches are written by the crawler's export thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        column_defs = ', '.join(['case_number TEXT PRIMARY KEY'] + [f'{column} REAL' if column in amount_columns else f'{column} TEXT' for column in columns])
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ({column_defs})')
+        self.conn.commit()
+
+    def write(self, buffer):
+        placeholders = ', '.join('?' for _ in local_columns)
+        with self.conn:
+            self.conn.executemany(f'INSERT OR REPLACE INTO {self.table} ({", ".join(local_columns)}) VALUES ({placeholders})',
+                                  zip(buffer.case_numbers, *(buffer.data[column] for column in columns)))
+
+    def close(self):
+        super().close()
+        self.conn.close()
+
+
+# The kinds of local output that can be picked in the configuration
+local_sinks = {'csv': CsvSink, 'parquet': ParquetSink, 'sqlite': SqliteSink}
+
+
+# This function opens a local sink by name
+def open_sink(kind, path, **kwargs):
+    if kind not in local_sinks:
+        raise ValueError(f"Unknown output '{kind}', expected one of: sheet, {', '.join(local_sinks)}")
+    return local_sinks[kind](path, **kwargs)
+
+
+# This function reads back the rows written by a local sink as (case_number, row) pairs, so they can be sent to the sheet.
+# When a case was written more than once only its latest row is returned, in the place of its first one.
+def read_rows(kind, path):
+    latest = {}
+    for case_number, row in stored_rows(kind, path):
+        latest[case_number] = row
+    return list(latest.items())
+
+
+# Every row written by a local sink in the order it was written
+def stored_rows(kind, path):
+    if kind == 'csv':
+        with open(path, newline='', encoding='utf-8') as f:
+            for record in csv.DictReader(f):
+                case_number = record.pop('case_number')
+                yield case_number, record
+    elif kind == 'sqlite':
+        conn = sqlite3.connect(path)
+        try:
+            cursor = conn.execute(f'SELECT {", ".join(local_columns)} FROM leads')
+            for values in cursor:
+                yield values[0], dict(zip(columns, values[1:]))
+        finally:
+            conn.close()
+    elif kind == 'parquet':
+        import pyarrow.parquet as pq
+
+        files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.parquet'))
+        for file_name in files:
+            for batch in pq.ParquetFile(file_name).iter_batches():
+                for record in batch.to_pylist():
+                    case_number = record.pop('case_number')
+                    yield case_number, record
+    else:
+        raise ValueError(f"Unknown output '{kind}', expected one of: {', '.join(local_sinks)}")